@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+'''
+ Bulk conversion of the archived runs to the columnar .col format.
+ Every <run>.npz of the archive gets a <run>.col next to it, with native
+ datetime64 columns and the metadata of the description file in the
+ header. Runs whose .col is newer than the .npz are skipped.
+
+ Usage: convert_archive.py [--archive ..] [--workers N] [--force]
+'''
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import experiments_indexer as indexer
+
+sys.path.append(os.path.join(indexer.ARCHIVE_DIR, 'Bi2Te3_Amoruso_ns'))
+from column_store import COLUMN_SUFFIX, convert_npz  # pylint: disable=wrong-import-position
+
+# Modo della sorgente dalla riga del file di descrizione
+SOURCE_PATTERNS = [('fixed', re.compile(r'^Current source fixed at', re.MULTILINE)),
+                   ('square', re.compile(r'^Current square waveform', re.MULTILINE)),
+                   ('flipped', re.compile(r'^Current source starts and ends', re.MULTILINE)),
+                   ('ramp', re.compile(r'^Current source from', re.MULTILINE))]
+SAMPLE_PATTERN = re.compile(r'^Name of the sample:\s*(.*)$', re.MULTILINE)
+
+
+def description_metadata(path):
+    """ Header metadata of an archived run, from its description file """
+    area, length = indexer.parse_description(path)
+    experiment = os.path.basename(path)
+    metadata = {'sample': None, 'title': os.path.basename(os.path.dirname(path)),
+                'date_time': experiment.rsplit('-', 1)[-1].replace('_a', ''),
+                'area': area, 'length': length, 'source_mode': None, 'description': ''}
+    try:
+        with open(path, encoding='utf-8') as file:
+            text = file.read()
+    except (OSError, UnicodeDecodeError):
+        return metadata
+    metadata['description'] = text
+    match = SAMPLE_PATTERN.search(text)
+    if match:
+        metadata['sample'] = match.group(1).strip()
+    for mode, pattern in SOURCE_PATTERNS:
+        if pattern.search(text):
+            metadata['source_mode'] = mode
+            break
+    return metadata
+
+
+def convert_run(job):
+    """ Convert one run, return (path, error message or None) """
+    archive_dir, relpath, force = job
+    npz_path = os.path.join(archive_dir, relpath)
+    col_path = npz_path[:-len('.npz')] + COLUMN_SUFFIX
+    if not force and os.path.exists(col_path) and \
+            os.path.getmtime(col_path) >= os.path.getmtime(npz_path):
+        return relpath, None
+    metadata = description_metadata(npz_path[:-len('.npz')])
+    if metadata['sample'] is None:
+        metadata['sample'] = relpath.split(os.sep)[0]
+    try:
+        convert_npz(npz_path, col_path, metadata)
+    except (OSError, KeyError, ValueError, TypeError) as error:
+        return relpath, str(error)
+    return relpath, None
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive', default=indexer.ARCHIVE_DIR, help='archive directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--force', action='store_true', help='convert every run again')
+    args = parser.parse_args()
+    runs = indexer.find_runs(args.archive)
+    errors = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [(args.archive, relpath, args.force) for relpath in runs]
+        for relpath, error in pool.map(convert_run, jobs, chunksize=8):
+            if error:
+                errors += 1
+                print(f"{relpath}: {error}")
+    print(f"{len(runs) - errors} of {len(runs)} runs converted")
+
+
+if __name__ == '__main__':
+    main()
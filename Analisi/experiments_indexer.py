@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+'''
+ Builder of the experiments index experiments_collector.csv/.npz.
+ Walks the sample directories of the archive, reads the description file
+ and the .npz data of every run and computes the temperature, current
+ density, resistivity and electric field columns used by plot_exp.ipynb
+ and classifier.ipynb.
+
+ The build is incremental: runs whose files have the same mtime and size
+ as in the cache are not read again, new runs are spread over a process
+ pool. The hand made Oscillation labels of the existing index are kept,
+ as the Osc scores written by oscillation_detector.py.
+ The level of detail pyramid used by the plots is built for the long runs
+ while they are indexed.
+
+ Usage: experiments_indexer.py [--archive ..] [--workers N] [--force]
+'''
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import lod_pyramid
+
+# Cartella di questo modulo, dove si trovano indice e notebook
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Archivio degli esperimenti: una cartella per campione
+ARCHIVE_DIR = os.path.dirname(ANALYSIS_DIR)
+COLLECTOR = os.path.join(ANALYSIS_DIR, 'experiments_collector')
+CACHE_FILE = COLLECTOR + '.cache.json'
+
+# Nome dei file di una misura: <titolo>-<AAAAMMGGhhmmss>[_a]
+RUN_PATTERN = re.compile(r'.+-\d{14}(_a)?$')
+# Cartelle che non contengono campioni
+SKIP_DIRS = {'Analisi', 'lib', '.git'}
+
+AREA_PATTERN = re.compile(r'^Area:\s*([-+0-9.eE]+)\s*cm', re.MULTILINE)
+LENGTH_PATTERN = re.compile(r'^Length:\s*([-+0-9.eE]+)\s*cm', re.MULTILINE)
+
+COLUMNS = ['Name', 'Thickness [cm]', 'Area [cm2]', 'Experiment', 'Start Date', 'End Date',
+           'Min Temperature [K]', 'Avg Temperature [K]', 'Max Temperature [K]',
+           'Min Current [A/cm2]', 'Avg Current [A/cm2]', 'Max Current [A/cm2]',
+           'Min Restivity [𝛀 cm]', 'Avg Restivity [𝛀 cm]', 'Max Restivity [𝛀 cm]',
+           'Min Electric Field [V/cm]', 'Avg Electric Field [V/cm]',
+           'Max Electric Field [V/cm]', 'Oscillation', 'Oscillation val']
+
+# Punteggi delle oscillazioni scritti da oscillation_detector.py
+SCORE_COLUMNS = ['Osc E Frequency [Hz]', 'Osc E Amplitude [V/cm]', 'Osc E Score',
+                 'Osc Rho Frequency [Hz]', 'Osc Rho Amplitude [𝛀 cm]', 'Osc Rho Score',
+                 'Osc Auto']
+
+# Colonne statistiche: (prefisso della colonna, campo dell'npz)
+STAT_FIELDS = [('Temperature [K]', 'temperature'), ('Current [A/cm2]', 'current_density'),
+               ('Restivity [𝛀 cm]', 'resistivity'),
+               ('Electric Field [V/cm]', 'electric_field')]
+
+# Nomi delle colonne nell'npz dell'indice
+NPZ_KEYS = {'Name': 'name', 'Thickness [cm]': 'thickness', 'Area [cm2]': 'area',
+            'Experiment': 'experiment',
+            'Min Temperature [K]': 'minT', 'Avg Temperature [K]': 'avgT',
+            'Max Temperature [K]': 'maxT',
+            'Min Current [A/cm2]': 'minJ', 'Avg Current [A/cm2]': 'avgJ',
+            'Max Current [A/cm2]': 'maxJ',
+            'Min Restivity [𝛀 cm]': 'minRho', 'Avg Restivity [𝛀 cm]': 'avgRho',
+            'Max Restivity [𝛀 cm]': 'maxRho',
+            'Min Electric Field [V/cm]': 'minE', 'Avg Electric Field [V/cm]': 'avgE',
+            'Max Electric Field [V/cm]': 'maxE', 'Oscillation': 'oscillations',
+            'Osc E Frequency [Hz]': 'oscFreqE', 'Osc E Amplitude [V/cm]': 'oscAmpE',
+            'Osc E Score': 'oscScoreE', 'Osc Rho Frequency [Hz]': 'oscFreqRho',
+            'Osc Rho Amplitude [𝛀 cm]': 'oscAmpRho', 'Osc Rho Score': 'oscScoreRho',
+            'Osc Auto': 'oscAuto'}
+# Colonne booleane dell'npz
+NPZ_FLAGS = {'oscillations'}
+# Colonne booleane con valori mancanti, salvate come 1, 0 e NaN
+NPZ_NULLABLE_FLAGS = {'oscAuto'}
+
+
+def find_runs(archive_dir=ARCHIVE_DIR):
+    """ Paths of the .npz runs of the archive, relative to archive_dir """
+    runs = []
+    for entry in sorted(os.listdir(archive_dir)):
+        top = os.path.join(archive_dir, entry)
+        if entry in SKIP_DIRS or entry.startswith('.') or not os.path.isdir(top):
+            continue
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.npz') and RUN_PATTERN.match(name[:-4]):
+                    runs.append(os.path.relpath(os.path.join(root, name), archive_dir))
+    return runs
+
+
+def signature(path):
+    """ (mtime, size) of a file, None if it does not exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def run_signature(path):
+    """ Signatures of the .npz, description and pyramid files of a run """
+    return [signature(path), signature(path[:-4]),
+            signature(path[:-4] + lod_pyramid.LOD_SUFFIX)]
+
+
+def parse_description(path):
+    """ (area [cm2], length [cm]) read from the description file of a run """
+    try:
+        with open(path, encoding='utf-8') as file:
+            text = file.read()
+    except (OSError, UnicodeDecodeError):
+        return np.nan, np.nan
+    values = []
+    for pattern in (AREA_PATTERN, LENGTH_PATTERN):
+        match = pattern.search(text)
+        try:
+            values.append(float(match.group(1)) if match else np.nan)
+        except ValueError:
+            values.append(np.nan)
+    return tuple(values)
+
+
+def index_run(archive_dir, relpath):
+    """ Index row of a run, None if its data can not be read """
+    path = os.path.join(archive_dir, relpath)
+    try:
+        data = np.load(path, allow_pickle=True)
+        stamps = np.asarray(data['datetime'], dtype='datetime64[us]')
+        columns = {field: np.asarray(data[field], dtype=float) for _prefix, field in STAT_FIELDS}
+    except (OSError, KeyError, ValueError, TypeError):
+        return None
+    if len(stamps) == 0:
+        return None
+    if len(stamps) > lod_pyramid.MAX_POINTS:
+        try:
+            lod_pyramid.save_pyramid(path[:-4], data)
+        except OSError:
+            pass
+    area, length = parse_description(path[:-4])
+    row = {'Name': relpath.split(os.sep)[0], 'Thickness [cm]': length, 'Area [cm2]': area,
+           'Experiment': os.path.basename(path)[:-4],
+           'Start Date': str(stamps[0]).replace('T', ' '),
+           'End Date': str(stamps[-1]).replace('T', ' ')}
+    for prefix, field in STAT_FIELDS:
+        values = columns[field]
+        with np.errstate(invalid='ignore'):
+            row['Min ' + prefix] = float(np.min(values))
+            row['Avg ' + prefix] = float(np.average(values))
+            row['Max ' + prefix] = float(np.max(values))
+    return row
+
+
+def _index_job(job):
+    archive_dir, relpath = job
+    return relpath, index_run(archive_dir, relpath)
+
+
+def load_cache(path=CACHE_FILE):
+    """ Cached rows by run path """
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_index(archive_dir=ARCHIVE_DIR, collector=COLLECTOR, workers=None, force=False):
+    """ Update the index, return it as DataFrame """
+    cache_path = collector + '.cache.json'
+    cache = {} if force else load_cache(cache_path)
+    runs = find_runs(archive_dir)
+    todo = []
+    for relpath in runs:
+        entry = cache.get(relpath)
+        if entry is None or entry['signature'] != run_signature(os.path.join(archive_dir,
+                                                                             relpath)):
+            todo.append(relpath)
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [(archive_dir, relpath) for relpath in todo]
+            for relpath, row in pool.map(_index_job, jobs, chunksize=8):
+                # La piramide appena scritta fa parte della firma
+                cache[relpath] = {'signature': run_signature(os.path.join(archive_dir, relpath)),
+                                  'row': row}
+    # Le misure rimosse dall'archivio escono anche dalla cache
+    cache = {relpath: cache[relpath] for relpath in runs}
+    with open(cache_path, 'w', encoding='utf-8') as file:
+        json.dump(cache, file)
+
+    rows = [entry['row'] for entry in cache.values() if entry['row'] is not None]
+    index = pd.DataFrame(rows, columns=COLUMNS[:-2])
+    index = index.sort_values(['Name', 'Start Date'], kind='stable').reset_index(drop=True)
+
+    # Etichette manuali e punteggi delle oscillazioni dell'indice esistente
+    labels = pd.DataFrame(columns=['Experiment', 'Oscillation', 'Oscillation val'])
+    scores = []
+    if os.path.exists(collector + '.csv'):
+        previous = pd.read_csv(collector + '.csv')
+        scores = [column for column in SCORE_COLUMNS if column in previous]
+        if 'Osc Auto' in previous:
+            previous['Osc Auto'] = previous['Osc Auto'].astype('boolean')
+        if 'Oscillation' in previous:
+            labels = previous[['Experiment', 'Oscillation', 'Oscillation val'] + scores] \
+                .drop_duplicates('Experiment')
+    index = index.merge(labels, on='Experiment', how='left')[COLUMNS + scores]
+    index.to_csv(collector + '.csv', index=False)
+    save_npz(index, collector)
+    return index
+
+
+def save_npz(index, collector=COLLECTOR):
+    """ numpy copy of the index, with the keys of the original file """
+    arrays = {}
+    for column, key in NPZ_KEYS.items():
+        if column not in index:
+            continue
+        values = index[column]
+        if key in NPZ_FLAGS:
+            arrays[key] = values.fillna(False).astype(bool).to_numpy()
+        elif key in NPZ_NULLABLE_FLAGS:
+            arrays[key] = values.astype('boolean').to_numpy(dtype=float, na_value=np.nan)
+        elif pd.api.types.is_numeric_dtype(values):
+            arrays[key] = values.to_numpy(dtype=float)
+        else:
+            arrays[key] = values.astype(str).to_numpy(dtype=str)
+    np.savez(collector + '.npz', **arrays)
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive', default=ARCHIVE_DIR, help='archive directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--force', action='store_true', help='ignore the cache')
+    args = parser.parse_args()
+    index = build_index(args.archive, workers=args.workers, force=args.force)
+    print(f"{len(index)} experiments indexed in {COLLECTOR}.csv")
+
+
+if __name__ == '__main__':
+    main()
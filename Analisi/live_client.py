@@ -0,0 +1,122 @@
+'''
+ Live plot of a running experiment in a notebook.
+ follow() subscribes to the live stream of the acquisition script or of
+ the scheduler (LIVE_STREAM = True in the .ini) and draws resistance,
+ voltage and temperature in a plotly FigureWidget, without touching the
+ disk. A background thread only receives the batches and queues them; a
+ timer on the event loop of the notebook kernel, the main thread, drains
+ the queue and redraws the figure with the traces min/max decimated as in
+ the plot window of the acquisition, so a frame costs the same at any
+ length of the run. A new sweep of the queue clears the traces.
+'''
+import asyncio
+import os
+import queue
+import sys
+import threading
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'Bi2Te3_Amoruso_ns'))
+# pylint: disable=wrong-import-position
+from live_stream import LIVE_HOST, LIVE_PORT, LiveSubscriber
+from live_plot import minmax_decimate
+from measure_buffer import MeasureBuffer
+
+# Intervallo fra due aggiornamenti della figura [s]
+REFRESH_INTERVAL = 0.5
+# Intervalli della decimazione min/max di una traccia
+DISPLAY_BUCKETS = 1000
+# Grafici: (campo, asse x, titolo dell'asse y)
+PANELS = [('resistance', 'temperature', 'Resistance [Ohm]'),
+          ('voltage', 'datetime', 'Voltage [V]'),
+          ('temperature', 'datetime', 'Temperature [°K]')]
+
+
+class LiveFollower:
+    """ FigureWidget following a live stream, stop() closes the connection
+
+    Outside of a running event loop the timer is not started: call
+    refresh() to draw the batches received so far.
+    """
+
+    def __init__(self, host=LIVE_HOST, port=LIVE_PORT, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        self.header = None
+        self.data = None
+        self.finished = False
+        self._batches = queue.SimpleQueue()
+        self.subscriber = LiveSubscriber(host, port)
+        self.figure = go.FigureWidget(make_subplots(rows=len(PANELS), cols=1,
+                                                    vertical_spacing=0.06))
+        for row, (field, x_field, label) in enumerate(PANELS, start=1):
+            self.figure.add_trace(go.Scattergl(x=[], y=[], mode='lines+markers', name=field),
+                                  row=row, col=1)
+            self.figure.update_yaxes(title_text=label, row=row, col=1)
+            self.figure.update_xaxes(title_text=x_field, row=row, col=1)
+        self.figure.update_layout(height=900, showlegend=False)
+        self._thread = threading.Thread(target=self._receive, name='live-follower',
+                                        daemon=True)
+        self._thread.start()
+        try:
+            self._timer = asyncio.get_running_loop().create_task(self._refresh_loop())
+        except RuntimeError:
+            self._timer = None
+
+    def _receive(self):
+        """ Reading thread, only queues the batches """
+        for batch in self.subscriber:
+            self._batches.put(batch)
+        self._batches.put(None)
+
+    def refresh(self):
+        """ Append the queued batches and redraw, on the main thread """
+        changed = False
+        while True:
+            try:
+                batch = self._batches.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                self.finished = True
+                break
+            header, rows = batch
+            if header is not self.header:
+                # Nuovo run, tracce vuote
+                self.header = header
+                self.data = MeasureBuffer(1, dtype=rows.dtype)
+            self.data.extend(rows)
+            changed = True
+        if changed:
+            self._draw()
+
+    def _draw(self):
+        rows = self.data.history()
+        with self.figure.batch_update():
+            title = self.header.get('title', '')
+            if self.subscriber.gaps:
+                title += f' ({self.subscriber.gaps} points skipped)'
+            self.figure.layout.title = title
+            for trace, (field, x_field, _label) in zip(self.figure.data, PANELS):
+                trace.x, trace.y = minmax_decimate(rows[x_field], rows[field], DISPLAY_BUCKETS)
+
+    async def _refresh_loop(self):
+        """ Timer of the kernel event loop, until the stream ends """
+        while not self.finished:
+            self.refresh()
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        """ Stop following the stream """
+        if self._timer is not None:
+            self._timer.cancel()
+        self.subscriber.close()
+
+
+def follow(host=LIVE_HOST, port=LIVE_PORT, interval=REFRESH_INTERVAL):
+    """ Subscribe to a running experiment, return the LiveFollower
+
+    Display its figure attribute in a cell to see the data arrive.
+    """
+    return LiveFollower(host, port, interval)
@@ -0,0 +1,151 @@
+'''
+ Level of detail pyramid of the archived runs, for interactive plots.
+ Every level keeps, for each bucket of LEVEL_FACTOR**k points, the rows
+ where the plotted fields reach their minimum and maximum, so peaks and
+ oscillations survive the decimation. The levels are saved next to the
+ run as <run>.lod.npz when the index is built, and load_window() picks
+ the finest level that draws a time window with at most MAX_POINTS
+ points, reading the full resolution data only when zoomed in.
+'''
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'Bi2Te3_Amoruso_ns'))
+from column_store import COLUMN_SUFFIX, open_columns  # pylint: disable=wrong-import-position
+
+# Estensione del file della piramide
+LOD_SUFFIX = '.lod.npz'
+# Rapporto tra le larghezze dei bucket di due livelli successivi
+LEVEL_FACTOR = 8
+# Punti massimi di una traccia dei grafici
+MAX_POINTS = 2000
+# Campi dei quali si conservano minimi e massimi
+LOD_FIELDS = ['temperature', 'electric_field', 'current_density', 'resistivity']
+
+
+def _bucket_extremes(values, width):
+    """ Indices of the minimum and maximum of every bucket of width points """
+    count = -(-len(values) // width)
+    padded = np.full(count * width, np.nan)
+    padded[:len(values)] = values
+    padded = padded.reshape(count, width)
+    finite = np.isfinite(padded)
+    offsets = np.arange(count) * width
+    low = np.argmin(np.where(finite, padded, np.inf), axis=1) + offsets
+    high = np.argmax(np.where(finite, padded, -np.inf), axis=1) + offsets
+    return np.concatenate((low, high))
+
+
+def minmax_indices(rows, width, fields=None):
+    """ Sorted row indices of the extremes of the fields in every bucket """
+    fields = [field for field in (fields or LOD_FIELDS) if field in rows.dtype.names]
+    length = len(rows)
+    indices = [np.array([0, length - 1])]
+    for field in fields:
+        indices.append(_bucket_extremes(rows[field].astype(float), width))
+    indices = np.unique(np.concatenate(indices))
+    return indices[indices < length]
+
+
+def as_records(columns):
+    """ Structured array of a mapping of columns, with datetime64 times """
+    arrays = {}
+    for name in columns.keys():
+        values = np.asarray(columns[name])
+        if name == 'datetime' or values.dtype == object:
+            values = values.astype('datetime64[us]')
+        arrays[name] = values
+    rows = np.empty(len(arrays['datetime']),
+                    dtype=[(name, values.dtype) for name, values in arrays.items()])
+    for name, values in arrays.items():
+        rows[name] = values
+    return rows
+
+
+def build_pyramid(columns, max_points=MAX_POINTS):
+    """ Levels of a run, finest first, down to max_points rows """
+    rows = as_records(columns)
+    levels = []
+    width = LEVEL_FACTOR
+    current = len(rows)
+    while current > max_points:
+        level = rows[minmax_indices(rows, width)]
+        if len(level) >= current:
+            break
+        levels.append(level)
+        current = len(level)
+        width *= LEVEL_FACTOR
+    return levels
+
+
+def save_pyramid(path_file, columns, max_points=MAX_POINTS):
+    """ Build and save the pyramid of a run, return its levels """
+    levels = build_pyramid(columns, max_points)
+    np.savez(path_file + LOD_SUFFIX,
+             **{f'level{k}': level for k, level in enumerate(levels, start=1)})
+    return levels
+
+
+def load_pyramid(path_file):
+    """ Saved levels of a run, finest first, None if not built """
+    try:
+        with np.load(path_file + LOD_SUFFIX) as data:
+            return [data[f'level{k}'] for k in range(1, len(data.files) + 1)]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def open_run(path_file):
+    """ Full resolution columns of a run, from the .col file if converted """
+    if os.path.exists(path_file + COLUMN_SUFFIX):
+        return open_columns(path_file + COLUMN_SUFFIX)
+    return np.load(path_file + '.npz', allow_pickle=True)
+
+
+def _row_range(times, start, stop):
+    first = 0 if start is None else np.searchsorted(times, start, side='left')
+    last = len(times) if stop is None else np.searchsorted(times, stop, side='right')
+    return first, last
+
+
+def _full_window(data, times, first, last):
+    window = {name: np.asarray(data[name][first:last]) for name in data.keys()}
+    window['datetime'] = times[first:last]
+    return window
+
+
+def load_window(path_file, start=None, stop=None, max_points=MAX_POINTS):
+    """ Columns of the run between start and stop, at most max_points rows
+
+    The full resolution rows are read when they are few enough, otherwise
+    the finest level of the pyramid that fits; the pyramid is built on the
+    fly when the run has not been indexed yet. ValueError for the runs
+    without measurement rows.
+    """
+    start = None if start in (None, '') else np.datetime64(start, 'us')
+    stop = None if stop in (None, '') else np.datetime64(stop, 'us')
+    data = open_run(path_file)
+    times = np.asarray(data['datetime']).astype('datetime64[us]')
+    if times.ndim != 1 or len(times) == 0:
+        # Vecchi run senza righe di misura (datetime 0-d)
+        raise ValueError(f"{path_file}: no measurement rows")
+    first, last = _row_range(times, start, stop)
+    if last - first <= max_points:
+        return _full_window(data, times, first, last)
+
+    levels = load_pyramid(path_file)
+    if levels is None:
+        try:
+            levels = save_pyramid(path_file, data, max_points)
+        except OSError:
+            levels = build_pyramid(data, max_points)
+    if not levels:
+        # Decimazione inutile, la finestra resta a piena risoluzione
+        return _full_window(data, times, first, last)
+    for level in levels:
+        first, last = _row_range(level['datetime'], start, stop)
+        if last - first <= max_points:
+            break
+    return {name: level[name][first:last] for name in level.dtype.names}
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+'''
+ Spectral oscillation detector of the archived runs.
+ The electric field and resistivity series of every run are resampled on
+ a uniform time grid from the datetime column; the trend of the current
+ sweep is removed with a moving median and the residual is analysed with
+ a linearly detrended Welch spectrum. The highest peak gives frequency and
+ amplitude of the oscillation, the amplitude relative to the median level
+ of the series gives the score. The runs are spread over a process pool
+ and the scores are cached by content hash of the .npz file, so only new
+ or changed runs are analysed again.
+ The scores are written as the Osc columns of experiments_collector.csv
+ and .npz, next to the hand made Oscillation labels; 'Osc Auto' is true
+ when the score of the resistivity reaches SCORE_THRESHOLD, empty for the
+ runs that could not be scored.
+
+ Usage: oscillation_detector.py [--archive ..] [--workers N] [--force]
+'''
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import ndimage, signal
+import experiments_indexer as indexer
+
+CACHE_FILE = indexer.COLLECTOR + '.oscillations.json'
+# Versione dell'analisi, cambiandola i punteggi in cache vengono ricalcolati
+ANALYSIS_VERSION = 1
+# Punti minimi di una serie e lunghezza dei segmenti di Welch
+MIN_POINTS = 16
+NPERSEG = 128
+# Finestra della mediana mobile che segue la rampa di corrente [punti]:
+# restano le oscillazioni con periodo fino a circa TREND_WINDOW passi
+TREND_WINDOW = 9
+# Ampiezza relativa minima di un'oscillazione della resistività; sulle 132
+# misure etichettate a mano concorda con l'etichetta nel 92% dei casi
+SCORE_THRESHOLD = 0.02
+# Serie analizzate: (campo dell'npz, nome nelle colonne, unità)
+SERIES = [('electric_field', 'E', 'V/cm'), ('resistivity', 'Rho', '𝛀 cm')]
+
+
+def uniform_series(seconds, values):
+    """ Series resampled every median sampling step, (step [s], values)
+
+    The non finite points are dropped first; None when less than
+    MIN_POINTS remain. values may be 2D, one series per row.
+    """
+    values = np.atleast_2d(values)
+    valid = np.isfinite(seconds) & np.all(np.isfinite(values), axis=0)
+    seconds, values = seconds[valid], values[:, valid]
+    if len(seconds) < MIN_POINTS:
+        return None
+    # Istanti ripetuti o non ordinati non sono interpolabili
+    order = np.argsort(seconds, kind='stable')
+    seconds, values = seconds[order], values[:, order]
+    keep = np.concatenate(([True], np.diff(seconds) > 0))
+    seconds, values = seconds[keep], values[:, keep]
+    step = float(np.median(np.diff(seconds))) if len(seconds) > 1 else 0.0
+    if step <= 0 or len(seconds) < MIN_POINTS:
+        return None
+    grid = np.arange(seconds[0], seconds[-1], step)
+    return step, np.vstack([np.interp(grid, seconds, row) for row in values])
+
+
+def spectra(values, step):
+    """ Welch power spectra of the rows of values, sweep trend removed """
+    trend = ndimage.median_filter(values, size=(1, TREND_WINDOW), mode='nearest')
+    return signal.welch(values - trend, fs=1.0 / step,
+                        nperseg=min(NPERSEG, values.shape[-1]), detrend='linear',
+                        scaling='spectrum', axis=-1)
+
+
+def peak(freqs, power):
+    """ Frequency [Hz] and amplitude of the highest peak of each spectrum """
+    # Componente continua esclusa
+    freqs, power = freqs[1:], power[:, 1:]
+    index = np.argmax(power, axis=1)
+    # Ampiezza della sinusoide con lo spettro di potenza scalato
+    return freqs[index], np.sqrt(2 * power[np.arange(len(power)), index])
+
+
+def analyze_run(seconds, columns):
+    """ {field: {'frequency', 'amplitude', 'score'}} of one run, None if too short """
+    series = uniform_series(seconds, np.vstack([columns[field] for field, *_ in SERIES]))
+    if series is None:
+        return None
+    step, values = series
+    if values.shape[-1] < MIN_POINTS:
+        return None
+    frequency, amplitude = peak(*spectra(values, step))
+    level = np.median(np.abs(values), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(level > 0, amplitude / level, np.nan)
+    return {field: {'frequency': float(frequency[i]), 'amplitude': float(amplitude[i]),
+                    'score': float(score[i])}
+            for i, (field, *_) in enumerate(SERIES)}
+
+
+def file_hash(path):
+    """ sha1 of the content of a file """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Hash già analizzati, passati ai processi del pool
+_known_hashes = set()
+
+
+def _init_worker(known):
+    global _known_hashes
+    _known_hashes = known
+
+
+def score_run(archive_dir, relpath):
+    """ (sha1, scores) of a run, scores None when cached or not readable """
+    path = os.path.join(archive_dir, relpath)
+    try:
+        sha1 = file_hash(path)
+    except OSError:
+        return None, None
+    if sha1 in _known_hashes:
+        return sha1, None
+    try:
+        data = np.load(path, allow_pickle=True)
+        stamps = np.asarray(data['datetime'], dtype='datetime64[us]')
+        columns = {field: np.asarray(data[field], dtype=float) for field, *_ in SERIES}
+    except (OSError, KeyError, ValueError, TypeError):
+        return sha1, None
+    seconds = (stamps - stamps[0]) / np.timedelta64(1, 's') if len(stamps) else \
+        np.empty(0)
+    return sha1, analyze_run(seconds, columns)
+
+
+def _score_job(job):
+    archive_dir, relpath = job
+    return relpath, score_run(archive_dir, relpath)
+
+
+def load_cache(path=CACHE_FILE):
+    """ Cached scores by run path, empty for another analysis version """
+    try:
+        with open(path, encoding='utf-8') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return cache.get('runs', {}) if cache.get('version') == ANALYSIS_VERSION else {}
+
+
+def score_archive(archive_dir=indexer.ARCHIVE_DIR, cache_path=CACHE_FILE, workers=None,
+                  force=False):
+    """ Oscillation scores of every run of the archive, by run path """
+    cache = {} if force else load_cache(cache_path)
+    by_hash = {entry['sha1']: entry['scores'] for entry in cache.values()}
+    runs = indexer.find_runs(archive_dir)
+    todo = [relpath for relpath in runs if relpath not in cache or
+            cache[relpath]['signature'] != indexer.signature(os.path.join(archive_dir,
+                                                                          relpath))]
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(set(by_hash),)) as pool:
+            jobs = [(archive_dir, relpath) for relpath in todo]
+            for relpath, (sha1, scores) in pool.map(_score_job, jobs, chunksize=8):
+                if sha1 is None:
+                    cache.pop(relpath, None)
+                    continue
+                if sha1 in by_hash:
+                    # Stesso contenuto di un run già analizzato, anche se spostato
+                    scores = by_hash[sha1]
+                by_hash[sha1] = scores
+                cache[relpath] = {'signature': indexer.signature(os.path.join(archive_dir,
+                                                                              relpath)),
+                                  'sha1': sha1, 'scores': scores}
+    cache = {relpath: cache[relpath] for relpath in runs if relpath in cache}
+    with open(cache_path, 'w', encoding='utf-8') as file:
+        json.dump({'version': ANALYSIS_VERSION, 'runs': cache}, file)
+    return {relpath: entry['scores'] for relpath, entry in cache.items()}
+
+
+def score_table(scores):
+    """ Osc columns of the index, one row per experiment """
+    rows = []
+    for relpath, run in scores.items():
+        row = {'Experiment': os.path.basename(relpath)[:-len('.npz')]}
+        for field, name, unit in SERIES:
+            values = run[field] if run is not None else {}
+            row[f'Osc {name} Frequency [Hz]'] = values.get('frequency', np.nan)
+            row[f'Osc {name} Amplitude [{unit}]'] = values.get('amplitude', np.nan)
+            row[f'Osc {name} Score'] = values.get('score', np.nan)
+        # Senza punteggio nessuna etichetta, non una falsa assenza di oscillazioni
+        score = row['Osc Rho Score']
+        row['Osc Auto'] = bool(score >= SCORE_THRESHOLD) if np.isfinite(score) else pd.NA
+        rows.append(row)
+    table = pd.DataFrame(rows, columns=['Experiment'] + indexer.SCORE_COLUMNS)
+    table['Osc Auto'] = table['Osc Auto'].astype('boolean')
+    return table.drop_duplicates('Experiment')
+
+
+def write_scores(scores, collector=indexer.COLLECTOR):
+    """ Replace the Osc columns of the index with scores, return the index """
+    index = pd.read_csv(collector + '.csv')
+    index = index.drop(columns=[column for column in indexer.SCORE_COLUMNS
+                                if column in index])
+    index = index.merge(score_table(scores), on='Experiment', how='left')
+    index.to_csv(collector + '.csv', index=False)
+    indexer.save_npz(index, collector)
+    return index
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--archive', default=indexer.ARCHIVE_DIR, help='archive directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--force', action='store_true', help='ignore the cache')
+    args = parser.parse_args()
+    scores = score_archive(args.archive, workers=args.workers, force=args.force)
+    index = write_scores(scores)
+    print(f"{len(scores)} runs scored, {int(index['Osc Auto'].sum())} "
+          f"of {len(index)} indexed experiments oscillate")
+
+
+if __name__ == '__main__':
+    main()
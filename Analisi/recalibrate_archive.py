@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+ Re-calibration of the thermometer of archived runs.
+ The diode voltages of every run are converted with a new DT-470 table in
+ one vectorized pass. Runs saved before the diode_voltage column existed
+ get their voltages back from the temperatures through the old table.
+ The re-calibrated runs are written as .col files under the output
+ directory, with the same relative paths as in the archive.
+
+ Usage: recalibrate_archive.py --new new.txt [--old old.txt] --out DIR
+                               [--match ChangedThermometer] [--archive ..]
+ Calibration files: two columns of temperature [K] and voltage [V], or an
+ .npz table saved by DiodeCalibration.save().
+'''
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import experiments_indexer as indexer
+
+sys.path.append(os.path.join(indexer.ARCHIVE_DIR, 'Bi2Te3_Amoruso_ns'))
+import lod_pyramid  # pylint: disable=wrong-import-position
+from dt470_table import DiodeCalibration  # pylint: disable=wrong-import-position
+from column_store import COLUMN_SUFFIX, write_columns  # pylint: disable=wrong-import-position
+
+
+def diode_voltages(rows, old):
+    """ Diode voltages of a run, NaN where they can not be recovered """
+    temp = rows['temperature'].astype(float)
+    if 'diode_voltage' in rows.dtype.names:
+        diode = rows['diode_voltage'].astype(float)
+    else:
+        diode = np.full(len(rows), np.nan)
+    missing = ~np.isfinite(diode)
+    if np.any(missing) and old is not None:
+        t_min, t_max = old.temperature_range
+        valid = missing & (temp >= t_min) & (temp <= t_max)
+        diode[valid] = old.temp_to_voltage(temp[valid])
+    return diode
+
+
+def recalibrate(rows, new, old=None):
+    """ Copy of the rows with temperatures of the new calibration """
+    diode = diode_voltages(rows, old)
+    v_min, v_max = new.voltage_range
+    valid = (diode >= v_min) & (diode <= v_max)
+    temp = np.full(len(rows), np.nan)
+    temp[valid] = new.voltage_to_temp(diode[valid])
+    columns = {name: rows[name] for name in rows.dtype.names}
+    columns['temperature'] = temp
+    columns['diode_voltage'] = diode
+    return columns
+
+
+def recalibrate_run(job):
+    """ Re-calibrate one archived run, return (path, points, error) """
+    archive_dir, relpath, out_dir, new_path, old_path = job
+    new = DiodeCalibration.load(new_path)
+    old = DiodeCalibration.load(old_path) if old_path else None
+    path_file = os.path.join(archive_dir, relpath)[:-len('.npz')]
+    try:
+        rows = lod_pyramid.as_records(lod_pyramid.open_run(path_file))
+        columns = recalibrate(rows, new, old)
+    except (OSError, KeyError, ValueError) as error:
+        return relpath, 0, str(error)
+    out_path = os.path.join(out_dir, relpath)[:-len('.npz')] + COLUMN_SUFFIX
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    write_columns(out_path, columns, {'recalibrated_from': relpath,
+                                      'calibration': os.path.abspath(new_path)})
+    return relpath, int(np.count_nonzero(np.isfinite(columns['temperature']))), None
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--new', required=True, help='new calibration file')
+    parser.add_argument('--old', help='calibration of the archived temperatures')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--match', default='', help='regular expression on the run path')
+    parser.add_argument('--archive', default=indexer.ARCHIVE_DIR, help='archive directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    args = parser.parse_args()
+    pattern = re.compile(args.match)
+    runs = [relpath for relpath in indexer.find_runs(args.archive) if pattern.search(relpath)]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [(args.archive, relpath, args.out, args.new, args.old) for relpath in runs]
+        for relpath, points, error in pool.map(recalibrate_run, jobs, chunksize=4):
+            if error:
+                print(f"{relpath}: {error}")
+            else:
+                print(f"{relpath}: {points} points re-calibrated")
+
+
+if __name__ == '__main__':
+    main()
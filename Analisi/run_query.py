@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+'''
+ Cross-run queries on temperature and current density.
+ The rows of every run are cut in blocks of BLOCK_ROWS consecutive points
+ and the interval index keeps, for each block, its row range, the ranges
+ of temperature and |J| and the temperature slope. A query finds the
+ blocks overlapping a temperature interval with a sorted search over the
+ index, reads only their row ranges (memory mapped from the .col file
+ when the run is converted) and filters the rows; aggregate() bins them
+ by temperature and returns mean and std of the resistivity for cooling
+ and warming separately, for R-vs-T hysteresis plots.
+ The index is saved as experiments_collector.intervals.npz and brought up
+ to date before every query: the runs are compared by signature, only the
+ new or changed ones are read again and the deleted ones are dropped.
+
+ Usage: run_query.py [--sample REGEX] [--t-min 120] [--t-max 160]
+                     [--j-max 0.05] [--bin 1] [--workers N]
+'''
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import experiments_indexer as indexer
+import lod_pyramid
+
+INDEX_FILE = indexer.COLLECTOR + '.intervals.npz'
+# Righe consecutive di un blocco dell'indice
+BLOCK_ROWS = 512
+# Pendenza minima della temperatura di un blocco in raffreddamento o riscaldamento [K/s]
+SLOPE_MIN = 1e-3
+# Verso della temperatura dei blocchi
+COOLING = -1
+STABLE = 0
+WARMING = 1
+DIRECTIONS = {'cooling': COOLING, 'stable': STABLE, 'warming': WARMING}
+# Colonne lette dalle righe selezionate
+QUERY_FIELDS = ['datetime', 'temperature', 'current_density', 'resistivity']
+
+BLOCK_DTYPE = np.dtype([('run', 'i4'), ('start', 'i8'), ('stop', 'i8'),
+                        ('t_min', 'f8'), ('t_max', 'f8'), ('j_min', 'f8'), ('j_max', 'f8'),
+                        ('slope', 'f8')])
+
+
+def direction(slope):
+    """ COOLING, STABLE or WARMING for temperature slopes [K/s] """
+    return np.where(slope <= -SLOPE_MIN, COOLING, np.where(slope >= SLOPE_MIN, WARMING,
+                                                            STABLE)).astype('i1')
+
+
+def run_blocks(data, block_rows=BLOCK_ROWS):
+    """ Blocks of a run without the run number, blocks without temperature skipped """
+    temp = np.asarray(data['temperature'], dtype=float)
+    current = np.abs(np.asarray(data['current_density'], dtype=float))
+    stamps = np.asarray(data['datetime']).astype('datetime64[us]')
+    seconds = (stamps - stamps[0]) / np.timedelta64(1, 's') if len(stamps) else \
+        np.empty(0)
+    blocks = []
+    for start in range(0, len(temp), block_rows):
+        stop = min(start + block_rows, len(temp))
+        t_block, j_block, s_block = temp[start:stop], current[start:stop], seconds[start:stop]
+        valid = np.isfinite(t_block) & np.isfinite(s_block)
+        if not np.any(valid):
+            continue
+        slope = 0.0
+        if np.count_nonzero(valid) > 1 and np.ptp(s_block[valid]) > 0:
+            slope = np.polyfit(s_block[valid], t_block[valid], 1)[0]
+        finite_j = j_block[np.isfinite(j_block)]
+        blocks.append((0, start, stop, t_block[valid].min(), t_block[valid].max(),
+                       finite_j.min() if len(finite_j) else np.nan,
+                       finite_j.max() if len(finite_j) else np.nan, slope))
+    return np.array(blocks, dtype=BLOCK_DTYPE)
+
+
+def _blocks_job(job):
+    archive_dir, relpath = job
+    path_file = os.path.join(archive_dir, relpath)[:-len('.npz')]
+    try:
+        return relpath, run_blocks(lod_pyramid.open_run(path_file))
+    except (OSError, KeyError, ValueError, TypeError):
+        return relpath, np.empty(0, dtype=BLOCK_DTYPE)
+
+
+def build_index(archive_dir=indexer.ARCHIVE_DIR, index_path=INDEX_FILE, workers=None,
+                force=False):
+    """ Update the interval index of the archive, return it as RunIndex
+
+    The file is written again only when some run was added, changed or removed.
+    """
+    previous = {}
+    if not force and os.path.exists(index_path):
+        old = RunIndex.load(index_path, archive_dir)
+        for number, relpath in enumerate(old.runs):
+            blocks = old.blocks[old.blocks['run'] == number]
+            previous[relpath] = (list(old.signatures[number]), blocks)
+    runs = indexer.find_runs(archive_dir)
+    signatures = {relpath: indexer.signature(os.path.join(archive_dir, relpath))
+                  for relpath in runs}
+    todo = [relpath for relpath in runs
+            if relpath not in previous or previous[relpath][0] != signatures[relpath]]
+    computed = {}
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [(archive_dir, relpath) for relpath in todo]
+            computed = dict(pool.map(_blocks_job, jobs, chunksize=8))
+    blocks = []
+    for number, relpath in enumerate(runs):
+        run = computed[relpath] if relpath in computed else previous[relpath][1].copy()
+        run['run'] = number
+        blocks.append(run)
+    blocks = np.concatenate(blocks) if blocks else np.empty(0, dtype=BLOCK_DTYPE)
+    index = RunIndex(np.array(runs, dtype=str),
+                     np.array([signatures[relpath] for relpath in runs], dtype='i8')
+                     .reshape(-1, 2), blocks, archive_dir)
+    if todo or len(previous) != len(runs):
+        index.save(index_path)
+    return index
+
+
+class RunIndex:
+    """ Interval index of the blocks of the archived runs, sorted by t_min """
+
+    def __init__(self, runs, signatures, blocks, archive_dir=indexer.ARCHIVE_DIR):
+        self.runs = runs
+        self.signatures = signatures
+        self.blocks = np.sort(blocks, order='t_min', kind='stable')
+        self.archive_dir = archive_dir
+        # Massima estensione in temperatura di un blocco, limita la ricerca a sinistra
+        self._max_span = float(np.max(self.blocks['t_max'] - self.blocks['t_min'])) \
+            if len(self.blocks) else 0.0
+
+    @classmethod
+    def load(cls, index_path=INDEX_FILE, archive_dir=indexer.ARCHIVE_DIR):
+        """ Index saved by save() """
+        with np.load(index_path) as data:
+            return cls(data['runs'], data['signatures'], data['blocks'], archive_dir)
+
+    def save(self, index_path=INDEX_FILE):
+        """ Save the index in numpy format """
+        np.savez(index_path, runs=self.runs, signatures=self.signatures, blocks=self.blocks)
+
+    def select(self, sample=None, t_min=-np.inf, t_max=np.inf, j_max=np.inf, j_min=0.0,
+               directions=None):
+        """ Blocks overlapping the temperature and |J| intervals
+
+        sample is a regular expression on the run path, directions a list
+        of 'cooling', 'stable' and 'warming'.
+        """
+        t_mins = self.blocks['t_min']
+        first = np.searchsorted(t_mins, t_min - self._max_span, side='left') \
+            if np.isfinite(t_min) else 0
+        last = np.searchsorted(t_mins, t_max, side='right')
+        blocks = self.blocks[first:last]
+        keep = (blocks['t_max'] >= t_min) & (blocks['j_min'] <= j_max) & \
+            (blocks['j_max'] >= j_min)
+        if directions is not None:
+            keep &= np.isin(direction(blocks['slope']),
+                            [DIRECTIONS[name] for name in directions])
+        if sample:
+            pattern = re.compile(sample)
+            matching = np.array([bool(pattern.search(relpath)) for relpath in self.runs])
+            keep &= matching[blocks['run']]
+        return np.sort(blocks[keep], order=['run', 'start'])
+
+    def rows(self, sample=None, t_min=-np.inf, t_max=np.inf, j_max=np.inf, j_min=0.0,
+             directions=None, fields=None):
+        """ Rows of the matching runs inside the intervals, read lazily
+
+        Return a dict of the QUERY_FIELDS columns plus 'run' (index in
+        self.runs) and 'direction' (COOLING, STABLE or WARMING) of each row.
+        """
+        fields = QUERY_FIELDS if fields is None else fields
+        parts = {name: [] for name in list(fields) + ['run', 'direction']}
+        blocks = self.select(sample, t_min, t_max, j_max, j_min, directions)
+        for number in np.unique(blocks['run']):
+            path_file = os.path.join(self.archive_dir, self.runs[number])[:-len('.npz')]
+            data = lod_pyramid.open_run(path_file)
+            # Colonne memory mapped dal file .col, un solo caricamento per colonna dall'npz
+            columns = {name: data[name]
+                       for name in set(fields) | {'temperature', 'current_density'}}
+            for block in blocks[blocks['run'] == number]:
+                start, stop = int(block['start']), int(block['stop'])
+                temp = np.asarray(columns['temperature'][start:stop], dtype=float)
+                current = np.abs(np.asarray(columns['current_density'][start:stop],
+                                            dtype=float))
+                keep = (temp >= t_min) & (temp <= t_max) & (current <= j_max) & \
+                    (current >= j_min)
+                for name in fields:
+                    values = np.asarray(columns[name][start:stop])
+                    if name == 'datetime':
+                        values = values.astype('datetime64[us]')
+                    parts[name].append(values[keep])
+                count = np.count_nonzero(keep)
+                parts['run'].append(np.full(count, number, dtype='i4'))
+                parts['direction'].append(np.full(count, direction(block['slope'])))
+        return {name: np.concatenate(values) if values else np.empty(0)
+                for name, values in parts.items()}
+
+
+def aggregate(rows, t_min, t_max, bin_width=1.0, field='resistivity'):
+    """ Temperature binned mean and std of a field, for cooling and warming
+
+    Return {'temperature': bin centers, 'cooling': {...}, 'warming': {...}}
+    where each direction has the 'count', 'mean' and 'std' arrays per bin,
+    NaN in the empty bins.
+    """
+    edges = np.arange(t_min, t_max + bin_width, bin_width)
+    bins = len(edges) - 1
+    result = {'temperature': (edges[:-1] + edges[1:]) / 2}
+    values = np.asarray(rows[field], dtype=float)
+    which = np.digitize(rows['temperature'], edges) - 1
+    valid = (which >= 0) & (which < bins) & np.isfinite(values)
+    for name in ('cooling', 'warming'):
+        selected = valid & (rows['direction'] == DIRECTIONS[name])
+        index, data = which[selected], values[selected]
+        count = np.bincount(index, minlength=bins)
+        total = np.bincount(index, weights=data, minlength=bins)
+        squares = np.bincount(index, weights=data * data, minlength=bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(squares / count - mean * mean, 0.0))
+        result[name] = {'count': count, 'mean': mean, 'std': std}
+    return result
+
+
+def query(sample=None, t_min=0.0, t_max=500.0, j_max=np.inf, bin_width=1.0,
+          index_path=INDEX_FILE, archive_dir=indexer.ARCHIVE_DIR, workers=None):
+    """ Cooling and warming resistivity of the matching runs, binned by temperature """
+    # Indice aggiornato: una stat per run, rilette solo le run cambiate
+    index = build_index(archive_dir, index_path, workers)
+    rows = index.rows(sample, t_min, t_max, j_max)
+    return aggregate(rows, t_min, t_max, bin_width)
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sample', default='', help='regular expression on the run path')
+    parser.add_argument('--t-min', type=float, default=0.0, help='minimum temperature [K]')
+    parser.add_argument('--t-max', type=float, default=500.0, help='maximum temperature [K]')
+    parser.add_argument('--j-max', type=float, default=np.inf, help='maximum |J| [A/cm2]')
+    parser.add_argument('--bin', type=float, default=1.0, help='temperature bin [K]')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--archive', default=indexer.ARCHIVE_DIR, help='archive directory')
+    args = parser.parse_args()
+    result = query(args.sample, args.t_min, args.t_max, args.j_max, args.bin,
+                   archive_dir=args.archive, workers=args.workers)
+    print(f"{'T [K]':>8} {'n cool':>7} {'rho cool':>11} {'std':>10} "
+          f"{'n warm':>7} {'rho warm':>11} {'std':>10}")
+    cooling, warming = result['cooling'], result['warming']
+    for i, temp in enumerate(result['temperature']):
+        if cooling['count'][i] or warming['count'][i]:
+            print(f"{temp:8.2f} {cooling['count'][i]:7d} {cooling['mean'][i]:11.4e} "
+                  f"{cooling['std'][i]:10.3e} {warming['count'][i]:7d} "
+                  f"{warming['mean'][i]:11.4e} {warming['std'][i]:10.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+'''
+ Acquisition primitives of the measurement loop.
+ Each reading function takes the nanovoltmeter and multimeter bus devices
+ and returns (sample voltage [V], diode voltage [V]); the buffered sweep
+ runs a whole current ramp from the 2400 source list into the 2182A trace
+ buffer and returns measurement rows.
+'''
+import logging
+from datetime import datetime
+from time import monotonic, perf_counter, sleep
+import numpy as np
+from gpib_bus import MEASURE
+from measure_buffer import MEASURE_DTYPE
+
+
+def source_current(conf):
+    """ Current levels of the run, its title and whether it is flipped """
+    sample_name = conf['SAMPLE_NAME']
+    samples = conf.getint('SOURCE_SAMPLES')
+    flipped = conf.getboolean('SOURCE_FLIPPED')
+    if conf.getboolean('SOURCE_FIXED'):
+        flipped = False
+        # Current fixed source
+        source = np.ones(samples) * conf.getfloat('SOURCE_FIXED_VALUE')
+        title = f"{sample_name} at fixed current {conf['SOURCE_FIXED_VALUE']}A"
+    elif conf.getboolean('SOURCE_SQUARE_WAVE'):
+        # scipy caricato solo per l'onda quadra
+        from scipy import signal  # pylint: disable=import-outside-toplevel
+        flipped = False
+        square_value = conf.getfloat('SOURCE_SQUARE_VALUE')
+        square_period = conf.getint('SOURCE_SQUARE_PERIOD')
+        t = np.linspace(0, 1, samples)
+        source = signal.square(2 * np.pi * square_period * t) * square_value
+        title = f"{sample_name} current square waveform value {square_value}A"
+    else:
+        # Current array of num sample from start to end equally spaced
+        source = np.linspace(conf.getfloat('SOURCE_MIN_VALUE'),
+                             conf.getfloat('SOURCE_MAX_VALUE'), samples)
+        title = f"{sample_name} current from {conf['SOURCE_MIN_VALUE']} \
+to {conf['SOURCE_MAX_VALUE']}A"
+    # Append flipped current array of num sample from end to start
+    if flipped:
+        source = np.concatenate((source, np.flip(source)))
+        title += ' flipped'
+    return source, title, flipped
+
+
+class Welford:
+    """ Streaming mean and variance of a sequence of readings """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        """ Add one reading """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """ Sample standard deviation, NaN with less than two readings """
+        if self.count < 2:
+            return float('nan')
+        return (self._m2 / (self.count - 1)) ** 0.5
+
+    @property
+    def relative_error(self):
+        """ Standard error of the mean relative to the mean """
+        if self.count < 2 or self.mean == 0:
+            return float('inf')
+        return self.std / self.count ** 0.5 / abs(self.mean)
+
+
+def measure_point(nanovolt, multimeter, read_meters, voltage_to_temp, avg, delay,
+                  target=None, max_samples=None, metrics=None):
+    """ Average the readings at the current level
+
+    Without target exactly avg readings are taken. With a target relative
+    standard error of the voltage, reading stops as soon as it is reached
+    after at least avg readings, or after max_samples readings.
+    voltage_to_temp converts an array of diode voltages in one call.
+    Return the voltage, temperature, diode_voltage, voltage_std,
+    temperature_std and n_samples fields of the point; errors of the
+    instruments and ValueError of out of range temperatures are raised to
+    the caller and the point is lost. With a metrics.Metrics the readings
+    and the sleep of DELAY are recorded as the 'loop read' and 'loop delay'
+    stages.
+    """
+    if target is None or max_samples is None:
+        max_samples = avg
+    stats = Welford()
+    diodes = np.empty(max(max_samples, avg))
+    while stats.count < len(diodes):
+        # Read Voltage with NanoVolt and temperature with the multimeter
+        start = perf_counter()
+        volt, diodes[stats.count] = read_meters(nanovolt, multimeter)
+        read_end = perf_counter()
+        stats.add(volt)
+        sleep(delay)
+        if metrics is not None:
+            metrics.record('loop read', read_end - start)
+            metrics.record('loop delay', perf_counter() - read_end)
+        if target is not None and stats.count >= avg and stats.relative_error <= target:
+            break
+    diodes = diodes[:stats.count]
+    temps = np.atleast_1d(voltage_to_temp(diodes))
+    return {'voltage': stats.mean, 'temperature': float(np.mean(temps)),
+            'diode_voltage': float(np.mean(diodes)), 'voltage_std': stats.std,
+            'temperature_std': float(np.std(temps, ddof=1)) if len(temps) > 1 else float('nan'),
+            'n_samples': stats.count}
+
+
+def setup_concurrent(nanovolt, multimeter):
+    """ Configure both meters for single, immediately triggered readings """
+    pending = [meter.write(command) for meter in (nanovolt, multimeter)
+               for command in (":INIT:CONT OFF", ":TRIG:SOUR IMM", ":TRIG:COUN 1")]
+    for future in pending:
+        future.result()
+
+
+def read_sequential(nanovolt, multimeter):
+    """ :READ? the nanovoltmeter, then the multimeter """
+    volt = float(nanovolt.query(':READ?', priority=MEASURE).result())
+    diode = float(multimeter.query(':READ?', priority=MEASURE).result())
+    return volt, diode
+
+
+def read_concurrent(nanovolt, multimeter):
+    """ Arm both meters, then fetch both readings
+
+    The two integrations overlap, so a reading takes as long as the
+    slower instrument instead of the sum of the two. :FETC? alone answers
+    the last reading in memory, *WAI makes each meter finish the new
+    integration first.
+    """
+    armed = (nanovolt.write(':INIT', priority=MEASURE),
+             multimeter.write(':INIT', priority=MEASURE))
+    volt = nanovolt.query('*WAI;:FETC?', priority=MEASURE)
+    diode = multimeter.query('*WAI;:FETC?', priority=MEASURE)
+    for future in armed:
+        future.result()
+    return float(volt.result()), float(diode.result())
+
+
+class AdaptiveSweep:
+    """ Current ramp refined where the I-V curve is not linear
+
+    The ramp starts from coarse equally spaced levels; every following
+    round inserts up to batch levels in the middle of the intervals with
+    the largest loss, until budget levels have been requested. The loss of
+    an interval is the largest area of the triangles made by three
+    consecutive measured points, in I and V normalized to their ranges,
+    that contain it: zero where the curve is linear, large at kinks,
+    steps and oscillations.
+    """
+
+    def __init__(self, start, stop, coarse, budget, batch=4):
+        self.budget = max(budget, coarse)
+        self.batch = batch
+        # Intervalli più stretti di così non vengono divisi
+        self.min_step = abs(stop - start) / (4 * self.budget)
+        self.requested = 0
+        self._pending = list(np.linspace(start, stop, coarse))
+        self._current = []
+        self._volt = []
+
+    @property
+    def done(self):
+        """ True when the budget is spent or nothing is left to refine """
+        return not self._pending and not self._refine()
+
+    def next_levels(self):
+        """ Current levels to measure in this round """
+        if not self._pending:
+            self._pending = self._refine()
+        levels, self._pending = self._pending, []
+        self.requested += len(levels)
+        return levels
+
+    def add(self, current, volt):
+        """ Record a measured point """
+        self._current.append(float(current))
+        self._volt.append(float(volt))
+
+    def levels(self):
+        """ Measured current levels, sorted """
+        return np.sort(self._current)
+
+    def losses(self):
+        """ (interval start, interval end, loss) of the measured curve """
+        order = np.argsort(self._current)
+        current = np.asarray(self._current)[order]
+        volt = np.asarray(self._volt)[order]
+        if len(current) < 3:
+            return current[:-1], current[1:], np.full(max(len(current) - 1, 0), np.inf)
+        span_i = np.ptp(current) or 1.0
+        span_v = np.ptp(volt) or 1.0
+        x = (current - current[0]) / span_i
+        y = (volt - volt.min()) / span_v
+        # Area del triangolo di ogni terna di punti consecutivi
+        area = 0.5 * np.abs((x[1:-1] - x[:-2]) * (y[2:] - y[:-2]) -
+                            (x[2:] - x[:-2]) * (y[1:-1] - y[:-2]))
+        loss = np.zeros(len(current) - 1)
+        loss[:-1] = area
+        loss[1:] = np.maximum(loss[1:], area)
+        return current[:-1], current[1:], loss
+
+    def _refine(self):
+        left = self.budget - self.requested
+        if left <= 0:
+            return []
+        low, high, loss = self.losses()
+        loss = np.where(np.abs(high - low) > 2 * self.min_step, loss, -1.0)
+        best = np.argsort(loss)[::-1][:min(self.batch, left)]
+        best = best[loss[best] > 0]
+        return list((low[best] + high[best]) / 2)
+
+
+def adaptive_levels(sweep, flipped):
+    """ Levels of an adaptive sweep, then back through them when flipped
+
+    The caller adds every measured point to the sweep before asking for
+    the next level, so each round is refined on the points measured so far.
+    """
+    while not sweep.done:
+        yield from sweep.next_levels()
+    if flipped:
+        yield from sweep.levels()[::-1]
+
+
+# Numero massimo di punti di una lista di sorgente del 2400
+SOURCE_LIST_MAX = 100
+# Attesa fra due controlli del riempimento del buffer del 2182A [s]
+TRACE_POLL = 0.2
+# Frequenza di rete [Hz], un NPLC dura 1/LINE_FREQUENCY s
+LINE_FREQUENCY = 50
+# Tempo concesso oltre la durata prevista della lista prima di rinunciare [s]
+TRACE_MARGIN = 5.0
+# Impostazioni cambiate da buffered_chunk, lette prima e ripristinate dopo,
+# nell'ordine in cui vengono riscritte (SOUR:DEL disattiva SOUR:DEL:AUTO)
+SOURCEMETER_LIST_STATE = [':SOUR:CURR:MODE', ':TRIG:COUN', ':TRIG:OUTP', ':TRIG:OLIN',
+                          ':TRIG:ILIN', ':TRIG:INP', ':SOUR:DEL', ':SOUR:DEL:AUTO']
+NANOVOLT_TRACE_STATE = [':TRAC:FEED:CONT', ':TRAC:POIN', ':TRAC:FEED', ':TRIG:SOUR',
+                        ':TRIG:COUN', ':FORM:DATA', ':FORM:BORD']
+
+
+def parse_block(raw, dtype='<f4'):
+    """ Decode an IEEE 488.2 definite length block: #<n><length><data> """
+    if not raw.startswith(b'#'):
+        raise ValueError(f"Not a binary block: {raw[:16]!r}")
+    digits = int(raw[1:2])
+    length = int(raw[2:2 + digits])
+    start = 2 + digits
+    return np.frombuffer(raw[start:start + length], dtype=dtype)
+
+
+def derive(current, volt, temp, times, area, length, diode=np.nan, volt_std=np.nan,
+           temp_std=np.nan, samples=1):
+    """ Build measurement rows from current, voltage and temperature arrays """
+    rows = np.empty(len(current), dtype=MEASURE_DTYPE)
+    rows['datetime'] = times
+    rows['temperature'] = temp
+    rows['diode_voltage'] = diode
+    rows['voltage_std'] = volt_std
+    rows['temperature_std'] = temp_std
+    rows['n_samples'] = samples
+    rows['voltage'] = volt
+    rows['current_source'] = current
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rows['resistance'] = volt / current
+        rows['electric_field'] = volt / length
+        rows['current_density'] = current / area
+        rows['resistivity'] = rows['electric_field'] / rows['current_density']
+    return rows
+
+
+class BufferTimeout(TimeoutError):
+    """ The 2182A trace buffer did not fill in the expected time """
+
+
+def query_state(device, settings):
+    """ Current value of each setting, read with one compound query """
+    answer = device.query(';'.join(setting + '?' for setting in settings),
+                          priority=MEASURE).result()
+    return dict(zip(settings, answer.decode('utf-8').strip().split(';')))
+
+
+def buffered_chunk(sm, nanovolt, levels, avg, delay, stop=None):
+    """ Source levels from the 2400 list, read them in the 2182A buffer
+
+    Every level is repeated avg times; the 2400 triggers the 2182A after
+    each source step over the trigger link and waits for its reading.
+    Return the avg readings of each level, shape (len(levels), avg), or
+    None if stop is set before the buffer is full. BufferTimeout is
+    raised when the buffer does not fill in the expected time (a lost
+    trigger or a compliance abort). Every setting changed for the list is
+    restored, whatever happens; a failed restore is logged and does not
+    hide the error of the list.
+    """
+    points = np.repeat(levels, avg)
+    count = len(points)
+    sm_state = query_state(sm, SOURCEMETER_LIST_STATE)
+    nanovolt_state = query_state(nanovolt, NANOVOLT_TRACE_STATE + [':SENS:VOLT:NPLC'])
+    nplc = float(nanovolt_state.pop(':SENS:VOLT:NPLC'))
+    complete = False
+    try:
+        pending = [
+            # Keithley 2400: lista di sorgente e trigger link
+            sm.write(":SOUR:CURR:MODE LIST", MEASURE),
+            sm.write(":SOUR:LIST:CURR " + ",".join(f"{i:.6e}" for i in points), MEASURE),
+            sm.write(f":SOUR:DEL {delay}", MEASURE),
+            sm.write(f":TRIG:COUN {count}", MEASURE),
+            sm.write(":TRIG:OUTP SOUR", MEASURE),
+            sm.write(":TRIG:OLIN 2", MEASURE),
+            sm.write(":TRIG:ILIN 1", MEASURE),
+            sm.write(":TRIG:INP SENS", MEASURE),
+            # Keithley 2182A: buffer riempito a ogni trigger esterno
+            nanovolt.write(":TRAC:CLE", MEASURE),
+            nanovolt.write(f":TRAC:POIN {count}", MEASURE),
+            nanovolt.write(":TRAC:FEED SENS", MEASURE),
+            nanovolt.write(":TRAC:FEED:CONT NEXT", MEASURE),
+            nanovolt.write(":TRIG:SOUR EXT", MEASURE),
+            nanovolt.write(f":TRIG:COUN {count}", MEASURE),
+            nanovolt.write(":INIT", MEASURE),
+            sm.write(":INIT", MEASURE),
+        ]
+        for future in pending:
+            future.result()
+        # Durata prevista della lista: con l'autozero ogni lettura integra due volte
+        timeout = count * (2 * nplc / LINE_FREQUENCY + delay) + TRACE_MARGIN
+        deadline = monotonic() + timeout
+        while not (stop is not None and stop.is_set()):
+            filled = int(nanovolt.query(":TRAC:POIN:ACT?", priority=MEASURE).result())
+            if filled >= count:
+                complete = True
+                break
+            if monotonic() > deadline:
+                raise BufferTimeout(f"2182A buffer not full after {timeout:.1f}s: "
+                                    f"{filled} of {count} readings")
+            sleep(TRACE_POLL)
+        if complete:
+            # Trasferimento binario dell'intero buffer
+            nanovolt.write(":FORM:DATA SREAL", MEASURE)
+            nanovolt.write(":FORM:BORD SWAP", MEASURE)
+            raw = nanovolt.query(":TRAC:DATA?", length=4 * count + 64, priority=MEASURE)
+            volts = parse_block(raw.result()).astype(float)
+    except BaseException:
+        # Ripristino senza nascondere l'errore che ha interrotto la lista
+        restore_state(sm, nanovolt, sm_state, nanovolt_state, complete)
+        raise
+    restore_state(sm, nanovolt, sm_state, nanovolt_state, complete, log_errors=False)
+    if not complete:
+        return None
+    return volts[:count].reshape(len(levels), avg)
+
+
+def restore_state(sm, nanovolt, sm_state, nanovolt_state, complete, log_errors=True):
+    """ Write back the settings read before a buffered chunk
+
+    With log_errors a failed write is only logged, so that the exception
+    that interrupted the chunk is the one raised to the caller.
+    """
+    restore = []
+    try:
+        if not complete:
+            # Lista interrotta: entrambi gli strumenti tornano in idle
+            restore += [sm.write(":ABOR", MEASURE), nanovolt.write(":ABOR", MEASURE)]
+        restore += [sm.write(f"{setting} {value}", MEASURE)
+                    for setting, value in sm_state.items()]
+        restore += [nanovolt.write(f"{setting} {value}", MEASURE)
+                    for setting, value in nanovolt_state.items()]
+        for future in restore:
+            future.result()
+    except Exception as e:  # pylint: disable=broad-except
+        if not log_errors:
+            raise
+        logging.error("Instrument settings not restored after the buffered chunk: %s", e)
+
+
+def buffered_sweep(sm, nanovolt, read_diode, voltage_to_temp, source, avg, delay, area,
+                   length, stop=None):
+    """ Run the whole current ramp as hardware buffered chunks
+
+    read_diode() returns the diode voltage in V; it is read before and after
+    each chunk and linearly interpolated over the chunk points, as are the
+    timestamps, then converted to temperature in one voltage_to_temp call.
+    Yield the measurement rows of every chunk.
+    """
+    size = max(SOURCE_LIST_MAX // avg, 1)
+    for start in range(0, len(source), size):
+        if stop is not None and stop.is_set():
+            break
+        levels = np.asarray(source[start:start + size], dtype=float)
+        diode_start = read_diode()
+        time_start = np.datetime64(datetime.now(), 'us')
+        readings = buffered_chunk(sm, nanovolt, levels, avg, delay, stop)
+        if readings is None:
+            break
+        volts = readings.mean(axis=1)
+        volt_std = readings.std(axis=1, ddof=1) if avg > 1 else np.nan
+        diode_end = read_diode()
+        time_end = np.datetime64(datetime.now(), 'us')
+        weight = (np.arange(len(levels)) + 0.5) / len(levels)
+        diode = diode_start + (diode_end - diode_start) * weight
+        times = time_start + ((time_end - time_start) * weight).astype('timedelta64[us]')
+        yield derive(levels, volts, voltage_to_temp(diode), times, area, length, diode,
+                     volt_std, samples=avg)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+'''
+ Acquisition throughput benchmark on the simulated GPIB bench.
+ For each source mode (fixed, ramp, flipped, square) runs the current loop
+ of the acquisition with the same primitives used by the script and
+ reports points per second, per-point latency percentiles and the time of
+ a live plot frame.
+
+ Usage: benchmark.py [--modes fixed ramp flipped square] [--points 50]
+                     [--avg 5] [--delay 0] [--concurrent] [--buffered]
+                     [--adaptive 1e-3 --max-samples 20] [--adaptive-sweep]
+                     [--replay run.npz] [--latency-scale 1] [--json out.json]
+        benchmark.py --smoke
+
+ --smoke runs a few points of every mode with the sequential, concurrent
+ and buffered readers and exits with status 1 if any of them fails: run it
+ after changing the acquisition modules.
+'''
+import argparse
+import configparser
+import json
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt  # pylint: disable=wrong-import-position
+import sim_gpib  # pylint: disable=wrong-import-position
+# Il simulatore prende il posto di linux-gpib prima dei moduli di acquisizione
+sim_gpib.install()
+import acquisition  # pylint: disable=wrong-import-position
+from gpib_bus import GpibBus, MEASURE  # pylint: disable=wrong-import-position
+from measure_buffer import MeasureBuffer  # pylint: disable=wrong-import-position
+from live_plot import LivePlot  # pylint: disable=wrong-import-position
+
+# Configurazione di base del campione simulato
+BASE_CONF = {
+    'SAMPLE_NAME': 'SIM', 'AREA': '0.05', 'LENGTH': '0.05',
+    'SOURCE_FIXED': 'False', 'SOURCE_FIXED_VALUE': '1e-3',
+    'SOURCE_SQUARE_WAVE': 'False', 'SOURCE_SQUARE_VALUE': '1e-3',
+    'SOURCE_SQUARE_PERIOD': '4', 'SOURCE_FLIPPED': 'False',
+    'SOURCE_MIN_VALUE': '1e-4', 'SOURCE_MAX_VALUE': '2e-3', 'LIMIT': '10',
+}
+
+# Opzioni dell'ini di ciascun modo di sorgente
+MODES = {
+    'fixed': {'SOURCE_FIXED': 'True'},
+    'ramp': {},
+    'flipped': {'SOURCE_FLIPPED': 'True'},
+    'square': {'SOURCE_SQUARE_WAVE': 'True'},
+}
+
+# Letture provate da --smoke, ciascuna su tutti i modi
+SMOKE_READERS = {
+    'sequential': {},
+    'concurrent': {'concurrent': True},
+    'buffered': {'buffered': True},
+}
+
+
+def mode_conf(mode, points):
+    """ Configuration section of a source mode """
+    config = configparser.ConfigParser()
+    config.read_dict({'DEFAULT': dict(BASE_CONF, SOURCE_SAMPLES=str(points), **MODES[mode])})
+    return config['DEFAULT']
+
+
+def percentiles(values):
+    """ 50th, 90th and 99th percentile in ms """
+    if len(values) == 0:
+        return [float('nan')] * 3
+    return [float(v) for v in np.percentile(np.asarray(values) * 1e3, [50, 90, 99])]
+
+
+def run_mode(mode, args):
+    """ Run one current loop on a fresh simulated bench, return the metrics """
+    trace = sim_gpib.Trace.from_npz(args.replay) if args.replay else None
+    lab = sim_gpib.SimLab(trace=trace, seed=0)
+    lab.scale_latency(args.latency_scale)
+    sim_gpib.install(lab)
+    bus = GpibBus()
+    multimeter = bus.device(sim_gpib.Gpib(0, sim_gpib.MULTIMETER_PAD))
+    nanovolt = bus.device(sim_gpib.Gpib(0, sim_gpib.NANOVOLT_PAD))
+    sm = bus.device(sim_gpib.Gpib(0, sim_gpib.SOURCEMETER_PAD))
+    sm.write(':OUTP ON').result()
+    conf = mode_conf(mode, args.points)
+    source, _title, _flipped = acquisition.source_current(conf)
+    area, length = conf.getfloat('AREA'), conf.getfloat('LENGTH')
+
+    read_meters = acquisition.read_sequential
+    if args.concurrent:
+        acquisition.setup_concurrent(nanovolt, multimeter)
+        read_meters = acquisition.read_concurrent
+
+    data = MeasureBuffer(int(len(source) * 1.15))
+    fig, axes = plt.subplots(3, 1, figsize=(16, 12))
+    live_plot = LivePlot(fig, [(axes[0], 'resistance', 'orange', '{:.3e}'),
+                               (axes[1], 'voltage', 'red', '{:.3e}'),
+                               (axes[2], 'temperature', 'yellow', '{:.2e}')])
+    fig.canvas.draw()
+
+    latencies = []
+    frames = []
+    start = time.perf_counter()
+    if args.buffered:
+        def read_diode():
+            return float(multimeter.query(':READ?', priority=MEASURE).result())
+        chunk_start = time.perf_counter()
+        for rows in acquisition.buffered_sweep(sm, nanovolt, read_diode,
+                                               sim_gpib.approx_diode_temperature, source,
+                                               args.avg, args.delay, area, length):
+            chunk_end = time.perf_counter()
+            # Latenza per punto: tempo del blocco diviso i suoi punti
+            latencies.extend([(chunk_end - chunk_start) / len(rows)] * len(rows))
+            data.extend(rows)
+            frame_start = time.perf_counter()
+            live_plot.update(data.window(), len(data))
+            frames.append(time.perf_counter() - frame_start)
+            chunk_start = time.perf_counter()
+    else:
+        sweep = None
+        levels = source
+        if args.adaptive_sweep and mode in ('ramp', 'flipped'):
+            sweep = acquisition.AdaptiveSweep(conf.getfloat('SOURCE_MIN_VALUE'),
+                                              conf.getfloat('SOURCE_MAX_VALUE'),
+                                              max(args.points // 4, 3), args.points)
+            levels = acquisition.adaptive_levels(sweep, mode == 'flipped')
+        for i in levels:
+            point_start = time.perf_counter()
+            sm.write(f":SOUR:CURR {i}", priority=MEASURE).result()
+            point = acquisition.measure_point(nanovolt, multimeter, read_meters,
+                                              sim_gpib.approx_diode_temperature,
+                                              args.avg, args.delay, args.adaptive,
+                                              args.max_samples)
+            data.extend(acquisition.derive(np.array([i]), np.array([point['voltage']]),
+                                           np.array([point['temperature']]),
+                                           np.array([datetime.now()], dtype='datetime64[us]'),
+                                           area, length, point['diode_voltage'],
+                                           point['voltage_std'], point['temperature_std'],
+                                           point['n_samples']))
+            if sweep is not None:
+                sweep.add(i, point['voltage'])
+            latencies.append(time.perf_counter() - point_start)
+            frame_start = time.perf_counter()
+            live_plot.update(data.window(), len(data))
+            frames.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+    bus.close()
+    plt.close(fig)
+    return {
+        'mode': mode,
+        'points': len(data),
+        'seconds': elapsed,
+        'points_per_second': len(data) / elapsed if elapsed > 0 else float('nan'),
+        'samples_per_point': float(np.mean(data.history()['n_samples'])) if len(data) else 0.0,
+        'latency_ms': dict(zip(('p50', 'p90', 'p99'), percentiles(latencies))),
+        'frame_ms': dict(zip(('p50', 'p90', 'p99'), percentiles(frames))),
+    }
+
+
+def smoke(args):
+    """ Few points of every mode and reader, return the exit status """
+    failed = []
+    for reader, options in SMOKE_READERS.items():
+        run_args = argparse.Namespace(**dict(vars(args), points=5, avg=2, **options))
+        for mode in MODES:
+            try:
+                points = run_mode(mode, run_args)['points']
+            except Exception as e:  # pylint: disable=broad-except
+                failed.append(f"{reader} {mode}: {e!r}")
+                continue
+            if points == 0:
+                failed.append(f"{reader} {mode}: no points")
+    for failure in failed:
+        print(f"FAILED {failure}")
+    print(f"smoke: {len(SMOKE_READERS) * len(MODES) - len(failed)} passed, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+def main():
+    """ Run the benchmark and print the report """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--points', type=int, default=50, help='SOURCE_SAMPLES')
+    parser.add_argument('--avg', type=int, default=5, help='AVG_MEASURE')
+    parser.add_argument('--delay', type=float, default=0.0, help='DELAY [s]')
+    parser.add_argument('--concurrent', action='store_true', help='CONCURRENT_READ')
+    parser.add_argument('--buffered', action='store_true', help='BUFFERED_SWEEP')
+    parser.add_argument('--adaptive', type=float, default=None, metavar='TARGET',
+                        help='ADAPTIVE_AVG with this AVG_TARGET_ERROR, --avg is the minimum')
+    parser.add_argument('--max-samples', type=int, default=None, help='AVG_MAX_SAMPLES')
+    parser.add_argument('--adaptive-sweep', action='store_true', help='ADAPTIVE_SWEEP')
+    parser.add_argument('--replay', help='archived .npz run to replay')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='factor applied to every instrument latency')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--smoke', action='store_true',
+                        help='quick run of every mode and reader, exit status 1 on failure')
+    args = parser.parse_args()
+    if args.smoke:
+        sys.exit(smoke(args))
+
+    results = [run_mode(mode, args) for mode in args.modes]
+    print(f"{'mode':8} {'points':>6} {'pts/s':>8} {'samples':>8} {'lat p50':>9} {'lat p90':>9} "
+          f"{'lat p99':>9} {'frame p50':>10} {'frame p99':>10}")
+    for res in results:
+        lat, frame = res['latency_ms'], res['frame_ms']
+        print(f"{res['mode']:8} {res['points']:6d} {res['points_per_second']:8.2f} "
+              f"{res['samples_per_point']:8.1f} "
+              f"{lat['p50']:7.1f}ms {lat['p90']:7.1f}ms {lat['p99']:7.1f}ms "
+              f"{frame['p50']:8.1f}ms {frame['p99']:8.1f}ms")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'args': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
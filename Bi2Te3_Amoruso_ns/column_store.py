@@ -0,0 +1,154 @@
+'''
+ Columnar, memory-mappable storage of a run (.col files).
+ Every field of the measurements is stored as a contiguous little-endian
+ block aligned on ALIGNMENT bytes, so a column is read with np.memmap
+ without decoding the rest of the file; datetimes are native datetime64.
+ The run metadata (sample, geometry, source mode, limits) is kept in the
+ JSON header.
+
+ File layout:
+   MAGIC, header length (uint32), JSON header with the number of rows,
+   the metadata and, for every column, its name, dtype and offset,
+   padding, then the column blocks.
+'''
+import json
+import os
+import struct
+from collections.abc import Mapping
+import numpy as np
+
+MAGIC = b'SPINCOL\x01'
+_UINT32 = struct.Struct('<I')
+
+# Estensione dei file colonnari
+COLUMN_SUFFIX = '.col'
+# Allineamento dei blocchi delle colonne, in byte
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _header_bytes(header):
+    return MAGIC + _UINT32.pack(0) + json.dumps(header).encode('utf-8')
+
+
+def write_columns(path, rows, metadata=None):
+    """ Save a structured array (or a dict of equal length arrays) as .col file """
+    if isinstance(rows, np.ndarray) and rows.dtype.names:
+        columns = {name: rows[name] for name in rows.dtype.names}
+    else:
+        columns = dict(rows)
+    columns = {name: np.asarray(values) for name, values in columns.items()}
+    for name, values in columns.items():
+        if values.dtype == object:
+            # Oggetti datetime dei vecchi npz
+            columns[name] = values.astype('datetime64[us]')
+        columns[name] = columns[name].astype(columns[name].dtype.newbyteorder('<'))
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns of {path} have different lengths")
+
+    header = {'rows': lengths.pop() if lengths else 0, 'metadata': metadata or {},
+              'columns': [{'name': name, 'dtype': values.dtype.str, 'offset': 0}
+                          for name, values in columns.items()]}
+    # Gli offset dipendono dalla lunghezza dell'intestazione che li contiene:
+    # si ripete finché non sono stabili
+    while True:
+        offset = _align(len(_header_bytes(header)))
+        changed = False
+        for column in header['columns']:
+            if column['offset'] != offset:
+                column['offset'] = offset
+                changed = True
+            offset = _align(offset + columns[column['name']].nbytes)
+        if not changed:
+            break
+
+    encoded = json.dumps(header).encode('utf-8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC + _UINT32.pack(len(encoded)) + encoded)
+        for column in header['columns']:
+            file.write(b'\0' * (column['offset'] - file.tell()))
+            file.write(columns[column['name']].tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """ JSON header of a .col file """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a column file")
+        (length,) = _UINT32.unpack(file.read(_UINT32.size))
+        return json.loads(file.read(length).decode('utf-8'))
+
+
+class ColumnStore(Mapping):
+    """ Read-only view of a .col file
+
+    Columns are memory mapped on first access, so only the pages actually
+    used are read from disk. Indexing by name returns the whole column,
+    like the NpzFile of np.load, and read() returns row ranges.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.metadata = self.header['metadata']
+        self.rows = self.header['rows']
+        self._columns = {column['name']: column for column in self.header['columns']}
+        self._maps = {}
+
+    def __getitem__(self, name):
+        if name not in self._maps:
+            column = self._columns[name]
+            if self.rows == 0:
+                self._maps[name] = np.empty(0, dtype=column['dtype'])
+            else:
+                self._maps[name] = np.memmap(self.path, dtype=column['dtype'], mode='r',
+                                             offset=column['offset'], shape=(self.rows,))
+        return self._maps[name]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def read(self, columns=None, start=0, stop=None):
+        """ Dict of zero-copy views of the rows [start:stop] of some columns """
+        names = list(self._columns) if columns is None else columns
+        return {name: self[name][start:stop] for name in names}
+
+    def to_records(self, columns=None, start=0, stop=None):
+        """ Copy of the rows [start:stop] as structured array """
+        views = self.read(columns, start, stop)
+        rows = np.empty(len(next(iter(views.values()))) if views else 0,
+                        dtype=[(name, view.dtype) for name, view in views.items()])
+        for name, view in views.items():
+            rows[name] = view
+        return rows
+
+
+def open_columns(path):
+    """ Open a .col file for reading """
+    return ColumnStore(path)
+
+
+def read_columns(path, columns=None, start=0, stop=None):
+    """ Read some columns and a row range of a .col file """
+    return open_columns(path).read(columns, start, stop)
+
+
+def convert_npz(npz_path, col_path=None, metadata=None):
+    """ Convert a .npz run of the acquisition to .col, return the new path """
+    if col_path is None:
+        col_path = npz_path[:-len('.npz')] + COLUMN_SUFFIX
+    with np.load(npz_path, allow_pickle=True) as data:
+        columns = {name: data[name] for name in data.files}
+    write_columns(col_path, columns, metadata)
+    return col_path
@@ -0,0 +1,120 @@
+'''
+ Table driven voltage to temperature conversion of the DT-470 diode.
+ The curve of lib.DT400TempSensor is sampled once over a voltage grid,
+ refined only at its knee and at the ends of its valid range, and then
+ interpolated with np.interp, so whole arrays of diode voltages
+ are converted in one call: the readings of a point in the measurement
+ loop, a buffered chunk or an archived run to re-calibrate.
+ A calibration can also be loaded from a two column text file
+ (temperature [K], voltage [V]) or from an .npz table saved by save().
+'''
+import numpy as np
+
+# Intervallo di tensione esplorato sul sensore [V]
+SENSOR_V_MIN = 0.0
+SENSOR_V_MAX = 1.8
+# Passo iniziale e passo minimo della griglia di tensione [V]
+SENSOR_V_COARSE = 1e-2
+SENSOR_V_STEP = 1e-4
+# Errore massimo dell'interpolazione lineare fra due punti della griglia [K]
+SENSOR_T_TOLERANCE = 1e-3
+
+
+class DiodeCalibration:
+    """ Monotone table of the diode voltage [V] against temperature [K]
+
+    voltage_to_temp() and temp_to_voltage() accept scalars or arrays and
+    raise ValueError, like DT400TempSensor, when a value is outside the
+    table.
+    """
+
+    def __init__(self, voltages, temperatures):
+        voltages = np.asarray(voltages, dtype=float)
+        temperatures = np.asarray(temperatures, dtype=float)
+        order = np.argsort(voltages)
+        self.voltages = voltages[order]
+        self.temperatures = temperatures[order]
+        if len(self.voltages) < 2 or np.any(np.diff(self.voltages) <= 0) or \
+                np.any(np.diff(self.temperatures) >= 0):
+            raise ValueError("The diode calibration is not monotone")
+        # Tabella inversa, temperature crescenti
+        self._temp_axis = self.temperatures[::-1]
+        self._volt_axis = self.voltages[::-1]
+
+    @classmethod
+    def from_sensor(cls, sensor, v_min=SENSOR_V_MIN, v_max=SENSOR_V_MAX,
+                    step=SENSOR_V_STEP, coarse=SENSOR_V_COARSE, tolerance=SENSOR_T_TOLERANCE):
+        """ Sample sensor.voltage_to_temp over its valid voltage range
+
+        The grid starts at the coarse step; an interval is halved, down to
+        step, while its midpoint is farther than tolerance [K] from the
+        linear interpolation or it crosses a limit of the valid range.
+        """
+        def sample(volt):
+            try:
+                return sensor.voltage_to_temp(float(volt))
+            except ValueError:
+                return np.nan
+
+        grid = np.arange(v_min, v_max + coarse / 2, coarse)
+        points = {volt: sample(volt) for volt in grid}
+        intervals = list(zip(grid[:-1], grid[1:]))
+        while intervals:
+            refine = []
+            for low, high in intervals:
+                t_low, t_high = points[low], points[high]
+                if (np.isnan(t_low) and np.isnan(t_high)) or high - low < 2 * step:
+                    continue
+                middle = (low + high) / 2
+                t_middle = points[middle] = sample(middle)
+                if np.isnan(t_low) or np.isnan(t_high) or np.isnan(t_middle) or \
+                        abs(t_middle - (t_low + t_high) / 2) > tolerance:
+                    refine += [(low, middle), (middle, high)]
+            intervals = refine
+        voltages = [volt for volt, temp in points.items() if not np.isnan(temp)]
+        return cls(voltages, [points[volt] for volt in voltages])
+
+    @classmethod
+    def load(cls, path):
+        """ Calibration saved by save() or text file of temperature, voltage """
+        if path.endswith('.npz'):
+            with np.load(path) as table:
+                return cls(table['voltage'], table['temperature'])
+        table = np.loadtxt(path, ndmin=2)
+        return cls(table[:, 1], table[:, 0])
+
+    def save(self, path):
+        """ Save the table in numpy format """
+        np.savez(path, voltage=self.voltages, temperature=self.temperatures)
+
+    @property
+    def voltage_range(self):
+        """ (minimum, maximum) voltage of the table """
+        return self.voltages[0], self.voltages[-1]
+
+    @property
+    def temperature_range(self):
+        """ (minimum, maximum) temperature of the table """
+        return self._temp_axis[0], self._temp_axis[-1]
+
+    def voltage_to_temp(self, volt):
+        """ Temperature [K] of diode voltages [V], ValueError out of range """
+        values = np.asarray(volt, dtype=float)
+        v_min, v_max = self.voltage_range
+        if np.any(~(values >= v_min) | ~(values <= v_max)):
+            raise ValueError(f"Diode voltage out of range {v_min}-{v_max}V")
+        temp = np.interp(values, self.voltages, self.temperatures)
+        return float(temp) if temp.ndim == 0 else temp
+
+    def temp_to_voltage(self, temp):
+        """ Diode voltage [V] at temperatures [K], ValueError out of range """
+        values = np.asarray(temp, dtype=float)
+        t_min, t_max = self.temperature_range
+        if np.any(~(values >= t_min) | ~(values <= t_max)):
+            raise ValueError(f"Temperature out of range {t_min}-{t_max}K")
+        volt = np.interp(values, self._temp_axis, self._volt_axis)
+        return float(volt) if volt.ndim == 0 else volt
+
+    def recalibrate(self, temp, new):
+        """ Temperatures measured with this calibration converted to another one """
+        return new.voltage_to_temp(self.temp_to_voltage(temp))
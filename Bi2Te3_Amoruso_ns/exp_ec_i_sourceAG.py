@@ -7,22 +7,29 @@
  Keithely multimeter 2000 or 2700 to measure temperature with silicon diode DT470
 '''
 from datetime import datetime
-from time import sleep
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 import sys
 import os
 import shutil
 import logging
-from scipy import signal
 from matplotlib import pyplot as plt
-from matplotlib import animation
 import easygui as eg
-import pandas as pd
 import numpy as np
 import gpib
-import Gpib
 from lib import DT400TempSensor as sensor
+from dt470_table import DiodeCalibration
+from measure_buffer import MeasureBuffer
+from live_plot import LivePlot
+from stream_writer import StreamWriter, STREAM_SUFFIX
+from live_stream import LivePublisher, LIVE_PORT
+from metrics import Metrics
+import experiment_io
+import gpib_bus
+from gpib_bus import GpibBus, Poller
+import acquisition
+import instruments
 
 # Creazione del file di logging
 logging.basicConfig(filename=sys.argv[0].replace('.py', '.log'),
@@ -53,37 +60,48 @@ SOURCE_FLIPPED = conf.getboolean('SOURCE_FLIPPED')
 continuous_mode = conf.getboolean('CONTINUOUS_MODE')
 # Numero di punti da visualizzare sul grafico
 DISPLAY_SAMPLES = int(SOURCE_SAMPLES * 1.15)
-
-# Select fixed or variable source
-if conf.getboolean('SOURCE_FIXED'):
-    SOURCE_FLIPPED = False
-    # Current fixed source
-    SOURCE_I =  np.ones(SOURCE_SAMPLES) * conf.getfloat('SOURCE_FIXED_VALUE')
-    title = f"{SAMPLE_NAME} at fixed current {conf['SOURCE_FIXED_VALUE']}A"
-else:
-    if conf.getboolean('SOURCE_SQUARE_WAVE'):
-        SOURCE_FLIPPED = False
-        SOURCE_SQUARE_VALUE = conf.getfloat('SOURCE_SQUARE_VALUE')
-        SOURCE_SQUARE_PERIOD = conf.getint('SOURCE_SQUARE_PERIOD')
-        t = np.linspace(0, 1, SOURCE_SAMPLES)
-        SOURCE_I = signal.square(( 2 * np.pi * SOURCE_SQUARE_PERIOD *t )) * SOURCE_SQUARE_VALUE
-        title = f"{SAMPLE_NAME} current square waveform value {SOURCE_SQUARE_VALUE}A"
-    else:
-        # Current min source
-        SOURCE_MIN_VALUE = conf.getfloat('SOURCE_MIN_VALUE')
-        # Current max source
-        SOURCE_MAX_VALUE = conf.getfloat('SOURCE_MAX_VALUE')
-        # Current array of num sample from start to end equally spaced
-        SOURCE_I = np.linspace(SOURCE_MIN_VALUE, SOURCE_MAX_VALUE, SOURCE_SAMPLES)
-        title = f"{SAMPLE_NAME} current from {conf['SOURCE_MIN_VALUE']} \
-to {conf['SOURCE_MAX_VALUE']}A"
+# Aggiornamento del grafico con blitting degli elementi che cambiano
+BLIT_PLOT = conf.getboolean('BLIT_PLOT', fallback=True)
+# Scrittura delle misure su disco durante l'acquisizione
+STREAM_DATA = conf.getboolean('STREAM_DATA', fallback=True)
+# Numero di punti per blocco e intervallo massimo fra due scritture [s]
+STREAM_BATCH = conf.getint('STREAM_BATCH', fallback=32)
+STREAM_FLUSH_INTERVAL = conf.getfloat('STREAM_FLUSH_INTERVAL', fallback=10.0)
+# Pubblicazione delle misure in diretta ai notebook, su localhost:LIVE_STREAM_PORT
+LIVE_STREAM = conf.getboolean('LIVE_STREAM', fallback=False)
+LIVE_STREAM_PORT = conf.getint('LIVE_STREAM_PORT', fallback=LIVE_PORT)
+# Intervallo di lettura della temperatura fra un ciclo di misura e l'altro [s]
+IDLE_POLL_INTERVAL = conf.getfloat('IDLE_POLL_INTERVAL', fallback=0.5)
+# Letture di nanovoltmetro e multimetro avviate insieme (INIT e FETC?)
+CONCURRENT_READ = conf.getboolean('CONCURRENT_READ', fallback=False)
+# Rampa di corrente dalla lista del 2400 con letture nel buffer del 2182A
+BUFFERED_SWEEP = conf.getboolean('BUFFERED_SWEEP', fallback=False)
+# Media adattiva: letture fino all'errore relativo AVG_TARGET_ERROR della tensione,
+# fra AVG_MIN_SAMPLES e AVG_MAX_SAMPLES letture
+ADAPTIVE_AVG = conf.getboolean('ADAPTIVE_AVG', fallback=False)
+AVG_TARGET_ERROR = conf.getfloat('AVG_TARGET_ERROR', fallback=1e-3)
+AVG_MIN_SAMPLES = conf.getint('AVG_MIN_SAMPLES', fallback=2)
+AVG_MAX_SAMPLES = conf.getint('AVG_MAX_SAMPLES', fallback=AVG_MEASURE)
+# Rampa adattiva: ADAPTIVE_COARSE_SAMPLES livelli equispaziati, poi ADAPTIVE_BATCH
+# livelli alla volta dove la curva I-V non è lineare, fino a SOURCE_SAMPLES livelli
+ADAPTIVE_SWEEP = conf.getboolean('ADAPTIVE_SWEEP', fallback=False)
+ADAPTIVE_COARSE_SAMPLES = conf.getint('ADAPTIVE_COARSE_SAMPLES',
+                                      fallback=max(SOURCE_SAMPLES // 4, 3))
+ADAPTIVE_BATCH = conf.getint('ADAPTIVE_BATCH', fallback=4)
+# Strumenti già configurati da un run precedente: niente *RST se lo stato coincide
+WARM_START = conf.getboolean('WARM_START', fallback=False)
+
+# Select fixed, square wave or variable source
+SOURCE_I, title, SOURCE_FLIPPED = acquisition.source_current(conf)
 
 # Append flipped current array of num sample from end to start
 if SOURCE_FLIPPED:
-    SOURCE_I = np.concatenate((SOURCE_I, np.flip(SOURCE_I)))
     DISPLAY_SAMPLES *= 2
-    title += ' flipped'
     logging.info('Source is flipped')
+if ADAPTIVE_SWEEP and (BUFFERED_SWEEP or conf.getboolean('SOURCE_FIXED') or
+                       conf.getboolean('SOURCE_SQUARE_WAVE')):
+    logging.warning('Adaptive sweep only for current ramps without buffered sweep, ignored')
+    ADAPTIVE_SWEEP = False
 
 logging.info('### Start experiment: %s ###', title)
 
@@ -91,77 +109,32 @@ logging.info('### Start experiment: %s ###', title)
 DELAY = conf.getfloat('DELAY')
 # Inizializzazione del sensore di temperatura al silicio
 dt400 = sensor.DT400TempSensor()
+# Tabella di conversione del diodo: file di calibrazione oppure curva del sensore
+DIODE_CALIBRATION = conf.get('DIODE_CALIBRATION', fallback='')
+if DIODE_CALIBRATION:
+    calibration = DiodeCalibration.load(DIODE_CALIBRATION)
+    logging.info('Diode calibration loaded from %s', DIODE_CALIBRATION)
+else:
+    calibration = DiodeCalibration.from_sensor(dt400)
 
-### Configurazione del multimetro Keithley 2700
-# Port GPIB 0, GPIB Intrument address 16
-try:
-    multimeter=Gpib.Gpib(0,16)
-    # Reset GPIB
-    multimeter.write("*RST")
-    # Identify request
-    multimeter.write("*IDN?")
-    # Read answer
-    logging.info('Found Multimeter %s', multimeter.read().decode("utf-8"))
-    # Select source function, mode Voltage reading only.
-    multimeter.write(":SENS:FUNC 'VOLT'")
-    # CHANNEL 1
-    multimeter.write(":FORM:ELEM READ")
-except gpib.GpibError as e:
-    logging.fatal("Multimeter doesn't respond: %s", e)
-    print("Multimeter doesn't respond, check it out!", e)
-    sys.exit(-1)
-
+# Latenze di bus, comandi GPIB e fasi del ciclo, salvate con il run
+metrics = Metrics()
+# Unico thread proprietario del bus GPIB, gli strumenti sono suoi client
+bus = GpibBus(metrics)
 
-### Configurazione del nano voltmeter Keithley 2182A
-# Port GPIB 0, GPIB Intrument address 7
+### Configurazione di multimetro Keithley 2700 (GPIB 16), nano voltmeter
+### Keithley 2182A (GPIB 7) e SourceMeter Keithley 2400 (GPIB 24)
+# Port GPIB 0, reset e configurazione dei tre strumenti insieme
 try:
-    nanovolt=Gpib.Gpib(0,7)
-    # Reset GPIB defaults
-    nanovolt.write("*RST")
-    # Identify request
-    nanovolt.write("*IDN?")
-    # Read answer
-    logging.info('Found Nanovolt Meter %s', nanovolt.read().decode("utf-8"))
-    # print(nanovolt.read().decode('utf-8'))
-    # Select source function, mode Voltage reading only.
-    nanovolt.write(":SENS:FUNC 'VOLT'")
-    # CHANNEL 1
-    nanovolt.write(":SENS:CHAN 1")
-except gpib.GpibError as e:
-    logging.fatal("Nanovolt meter doesn't respond: %s" , e)
-    print("Nanovolt meter doesn't respond, check it out!", e)
+    multimeter, nanovolt, sm = instruments.bring_up(bus, SOURCE_I[0], conf["LIMIT"],
+                                                    WARM_START)
+except instruments.BringUpError as e:
+    logging.fatal("%s doesn't respond: %s", e.instrument, e.error)
+    print(f"{e.instrument} doesn't respond, check it out!", e.error)
     sys.exit(-1)
 
-### Configurazione del SourceMeter Keithley 2400
-# Port GPIB 0, GPIB Intrument address 24
-try:
-    sm=Gpib.Gpib(0,24)
-    # Reset GPIB defaults
-    sm.write("*RST")
-    # Identify request
-    sm.write("*IDN?")
-    # Read answer from device
-    logging.info('Found Source Meter %s', sm.read().decode("utf-8"))
-    # print(sm.read().decode('utf-8'))
-### Select source function, mode '''
-    #Select current source.
-    sm.write(":SOUR:FUNC CURR")
-    # Select source range.
-    #sm.write(":SOUR:CURR:RANG 10E-3")
-    # Source output.
-    sm.write(f":SOUR:CURR:LEV {SOURCE_I[0]}")
-    # Voltage compliance.
-    sm.write(f':SENS:VOLT:PROT {conf["LIMIT"]}')
-    # Voltage measure function.
-    sm.write(":SENS:FUNC 'VOLT'")
-    # Voltage reading only.
-    sm.write(":FORM:ELEM VOLT")
-    # Turn on source meter output
-    sm.write(":OUTP ON")
-except gpib.GpibError as e:
-    logging.fatal("Source meter 2400 doesn't respond: %s", e)
-    print("Source meter doesn't respond, check it out!", e)
-    sys.exit(-1)
+# Lettura contemporanea dei due strumenti
+read_meters = instruments.select_reader(nanovolt, multimeter, CONCURRENT_READ)
 
 ### Configurazione del SourceMeter Keithley 6221
 # Port GPIB 0, GPIB Intrument address 24
@@ -190,36 +163,66 @@ except gpib.GpibError as e:
 # Instantiate threading event handler
 # Evento uscita dal ciclo di misura
 exit_event = threading.Event()
+# Ciclo di corrente in corso
+start_measurements = False
+
+# Buffer delle misure condiviso fra thread di misura, grafico e salvataggio
+data = MeasureBuffer(DISPLAY_SAMPLES)
+
+# Stream delle misure, recuperabile con recover_stream.py in caso di crash
+stream = None
+if STREAM_DATA:
+    start_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    stream_path = experiment_io.experiment_file(SAMPLE_NAME, title, start_time) + STREAM_SUFFIX
+    stream = StreamWriter(stream_path, data.dtype,
+                          {'title': title, 'date_time': start_time,
+                           'source_flipped': SOURCE_FLIPPED, 'conf': dict(conf)},
+                          batch_size=STREAM_BATCH, flush_interval=STREAM_FLUSH_INTERVAL)
+    logging.info("Streaming data to %s", stream_path)
+
+# Misure in diretta per i notebook (Analisi/live_client.py)
+live = None
+if LIVE_STREAM:
+    try:
+        live = LivePublisher({'title': title, 'sample': SAMPLE_NAME,
+                              'source_flipped': SOURCE_FLIPPED}, port=LIVE_STREAM_PORT)
+    except OSError as e:
+        logging.warning("Live stream not available: %s", e)
+
+def read_diode():
+    """ Thermometer diode voltage read by the multimeter """
+    return float(multimeter.query(':READ?', priority=gpib_bus.MEASURE).result())
+
+def buffered_current_loop():
+    """ Current loop run by the source meter list, readings transferred in bulk """
+    try:
+        for rows in acquisition.buffered_sweep(sm, nanovolt, read_diode,
+                                               calibration.voltage_to_temp, SOURCE_I,
+                                               AVG_MEASURE, DELAY, AREA, LENGTH,
+                                               stop=exit_event):
+            compliance = rows['voltage'] >= float(conf["LIMIT"])*0.95
+            if np.any(compliance):
+                logging.warning("Voltage compliance on %d points", np.count_nonzero(compliance))
+                metrics.count('compliance', int(np.count_nonzero(compliance)))
+            rows = rows[~compliance]
+            metrics.count('points', len(rows))
+            logging.info("Buffered measurement of %d points, last current %s",
+                         len(rows), rows['current_source'][-1] if len(rows) else None)
+            data.extend(rows)
+            if stream is not None:
+                stream.extend(rows)
+            if live is not None:
+                live.extend(rows)
+    except (ValueError, acquisition.BufferTimeout) as e:
+        logging.warning("Buffered sweep interrupted: %s", e)
+    except gpib.GpibError as e:
+        logging.warning("Reading gpib error, check the instruments: %s", e)
 
 def measure_thread_function():
     """ Measurement thread """
     global start_measurements
     start_measurements = False
 
-    # Array of resistence values
-    global R
-    R = []
-    # Array of temperature measures
-    global T
-    T = []
-    # Array of datetime
-    global DT
-    DT = []
-    # Array of voltage measures
-    global V
-    V = []
-    # Array of current values
-    global I
-    I = []
-    # Array of resistivity values
-    global RHO
-    RHO = []
-    # Array of electric field values
-    global E
-    E = []
-    # Array of current density values
-    global J
-    J = []
     if continuous_mode:
         eg.msgbox('Start new measurement loop in continuous mode; \
 to stop and save the measurements close the plot window')
@@ -230,7 +233,7 @@ to stop and save the measurements close the plot window')
     while True:
         try:
             # Impostazione del valore iniziale della corrente
-            sm.write(f":SOUR:CURR {SOURCE_I[0]}")
+            sm.write(f":SOUR:CURR {SOURCE_I[0]}", priority=gpib_bus.MEASURE).result()
         except gpib.GpibError as e:
             logging.warning("Writing gpib error, check the source meter: %s", e)
             # print(f"Writing gpib error: {e}")
@@ -244,8 +247,7 @@ to stop and save the measurements close the plot window')
             while 'temperature' in answer:
                 try:
                     # Read temperature
-                    multimeter.write(':READ?')
-                    tmp= dt400.voltage_to_temp(float(multimeter.read()))
+                    tmp= calibration.voltage_to_temp(float(multimeter.query(':READ?').result()))
                 except ValueError:
                     logging.warning('Temperature out of range!')
                 except gpib.GpibError as e:
@@ -260,9 +262,20 @@ to stop and save the measurements close the plot window')
                 break
 
         start_measurements = True
+        if BUFFERED_SWEEP:
+            buffered_current_loop()
+            continue
         # nvolt_measure_prev = -1000.0
+        sweep = None
+        levels = SOURCE_I
+        if ADAPTIVE_SWEEP:
+            sweep = acquisition.AdaptiveSweep(conf.getfloat('SOURCE_MIN_VALUE'),
+                                              conf.getfloat('SOURCE_MAX_VALUE'),
+                                              ADAPTIVE_COARSE_SAMPLES, SOURCE_SAMPLES,
+                                              ADAPTIVE_BATCH)
+            levels = acquisition.adaptive_levels(sweep, SOURCE_FLIPPED)
         # Ciclo della corrente
-        for i in SOURCE_I:
+        for i in levels:
             try:
                 # Thread exits, interruzione del ciclo della corrente
                 if exit_event.is_set():
@@ -270,73 +283,68 @@ to stop and save the measurements close the plot window')
                     # print("Uscita ciclo di corrente")
                     break
                 # Impostazione della corrente.
-                sm.write(f":SOUR:CURR {i}")
+                with metrics.stage('loop set current'):
+                    sm.write(f":SOUR:CURR {i}", priority=gpib_bus.MEASURE).result()
                 logging.info("Measurement at current %s", i)
-                error = False
-                volt_sum = 0.0
-                temp_sum = 0.0
             except gpib.GpibError as e:
                 logging.warning("Writing gpib error, check the source meter: %s", e)
                 # print(f"Writing gpib error: {e}")
 
-            # Ciclo su n misure
-            for _j in range(AVG_MEASURE):
-                # print(f"\nMisura :{_j}\n")
-                try:
-                    # Read Voltage with NanoVolt
-                    nanovolt.write(':READ?')
-                    nvolt_measure = float(nanovolt.read())
-                    volt_sum += nvolt_measure
-                    # sleep(DELAY)
-                    # Read temperature
-                    multimeter.write(':READ?')
-                    temp_measure = dt400.voltage_to_temp(float(multimeter.read()))
-                    temp_sum += temp_measure
-                    sleep(DELAY)
-                    error = False
-                except ValueError:
-                    error = True
-                    logging.warning('Temperature out of range!')
-                    # print("Temperature out of range!")
-                    break
-                except gpib.GpibError as e:
-                    error = True
-                    logging.warning("Reading gpib error, check the instruments: %s", e)
-                    # print(f"Reading error, check the instruments: {e}")
-                    break
+            # Media su AVG_MEASURE misure, o adattiva
+            try:
+                if ADAPTIVE_AVG:
+                    point = acquisition.measure_point(nanovolt, multimeter, read_meters,
+                                                      calibration.voltage_to_temp,
+                                                      AVG_MIN_SAMPLES, DELAY,
+                                                      AVG_TARGET_ERROR, AVG_MAX_SAMPLES,
+                                                      metrics=metrics)
+                else:
+                    point = acquisition.measure_point(nanovolt, multimeter, read_meters,
+                                                      calibration.voltage_to_temp,
+                                                      AVG_MEASURE, DELAY, metrics=metrics)
+                volt, temp = point['voltage'], point['temperature']
+                error = False
+            except ValueError:
+                error = True
+                logging.warning('Temperature out of range!')
+                metrics.count('lost points')
+                metrics.count('temperature out of range')
+                # print("Temperature out of range!")
+            except gpib.GpibError as e:
+                error = True
+                logging.warning("Reading gpib error, check the instruments: %s", e)
+                metrics.count('lost points')
+                # print(f"Reading error, check the instruments: {e}")
             if not error:
-                temp = temp_sum/AVG_MEASURE
-                volt = volt_sum/AVG_MEASURE
                 res = volt/i
                 e_field = volt/LENGTH
                 c_density = i/AREA
                 rho = e_field/c_density
-                log_measure = f'T:{temp:.2f}°K V:{volt:.4e}V I:{i:.4e}A R:{res:.4e}𝛀 \
-E:{e_field:.4e}V/cm J:{c_density:.4e}A/cm2 𝛒:{rho:.4e}𝛀 cm'
                 # print(f'T:{temp:.2f}°K V:{volt:.4e}V I:{i:.4e}A R:{res:.4e}𝛀 \
 #E:{e_field:.4e}V/cm J:{c_density:.4e}A/cm2 𝛒:{rho:.4e}𝛀 cm',
 #                end="\r")
-                logging.info('%s', log_measure)
+                with metrics.stage('loop log'):
+                    # Formattazione differita, solo se il messaggio viene scritto
+                    logging.info('T:%.2f°K V:%.4eV I:%.4eA R:%.4e𝛀 E:%.4eV/cm J:%.4eA/cm2 '
+                                 '𝛒:%.4e𝛀 cm σV:%.2eV n:%d', temp, volt, i, res, e_field,
+                                 c_density, rho, point["voltage_std"], point["n_samples"])
                 if volt >= float(conf["LIMIT"])*0.95:
                     logging.warning("Voltage compliance")
+                    metrics.count('compliance')
                 else:
-                    # Update current array
-                    I.append(i)
-                    # Update voltage array
-                    V.append(volt)
-                    # Update resistance array
-                    R.append(res)
-                    # Update temperature array
-                    T.append(temp)
-                    # Update datetime array
-                    DT.append(datetime.now())
-                    # Derivazione degli altri parametri
-                    # Campo elettrico
-                    E.append(e_field)
-                    # Densità di corrente
-                    J.append(c_density)
-                    # Resistività
-                    RHO.append(rho)
+                    with metrics.stage('loop store'):
+                        point.update({'datetime': datetime.now(), 'resistance': res,
+                                      'current_source': i, 'electric_field': e_field,
+                                      'current_density': c_density, 'resistivity': rho})
+                        # Aggiornamento del buffer delle misure
+                        data.append(**point)
+                        if sweep is not None:
+                            sweep.add(i, volt)
+                        if stream is not None:
+                            stream.append(**point)
+                        if live is not None:
+                            live.append(**point)
+                    metrics.count('points')
 
 # Configure and Start Measurement thread loop
 thr_measure = threading.Thread(target=measure_thread_function)
@@ -352,159 +360,103 @@ ax0.grid()
 ax1.grid()
 ax2.grid()
 
-# Lista delle annotazioni
-ann_list = []
+# Linee e annotazioni persistenti, aggiornate ad ogni frame
+live_plot = LivePlot(fig, [(ax0, 'resistance', 'orange', '{:.3e}'),
+                           (ax1, 'voltage', 'red', '{:.3e}'),
+                           (ax2, 'temperature', 'yellow', '{:.2e}')], blit=BLIT_PLOT)
 
-def update_plot(i):
-    """ animation function.  This is called sequentially """
-   # print(i, T[i], R[i])
-    N = len(DT)
-    if not start_measurements:
-        try:
-            # Read temperature
-            multimeter.write(':READ?')
-            tmp= dt400.voltage_to_temp(float(multimeter.read()))
-            print(f'Current Temperature:{tmp:.2f}°K', end='\r')
-        except gpib.GpibError as e:
-            logging.warning("Reading gpib error, check the multimeter: %s", e)
-        except ValueError:
-            logging.warning('Temperature out of range!')
+# Lettura della temperatura a bassa priorità quando non si misura
+temperature_poller = Poller(multimeter, ':READ?', IDLE_POLL_INTERVAL,
+                            enabled=lambda: not start_measurements)
 
-# Settore incriminato
+def update_plot():
+    """ Plot timer callback, called every 500 ms """
+    if not start_measurements:
+        # Ultima temperatura letta dal poller, la GUI non attende il bus
+        reading, error = temperature_poller.take()
+        if isinstance(error, gpib.GpibError):
+            logging.warning("Reading gpib error, check the multimeter: %s", error)
+        elif reading is not None:
+            try:
+                tmp= calibration.voltage_to_temp(float(reading))
+                print(f'Current Temperature:{tmp:.2f}°K', end='\r')
+            except ValueError:
+                logging.warning('Temperature out of range!')
     else:
-        if N > DISPLAY_SAMPLES:
-            ax0.cla()
-            ax0.grid()
-            ax1.cla()
-            ax1.grid()
-            ax2.cla()
-            ax2.grid()
-            ax0.set(ylabel='Resistance [Ohm]', xlabel='Temperature [°K], title=title)
-            ax1.set(ylabel='Voltage [V]', xlabel='Time')# , yscale='log', xscale='log')
-            ax2.set(ylabel='Temperature [°K]', xlabel='Time') # , yscale='log', xscale='log')
-            #ax0.set_xlim([DT[N - DISPLAY_SAMPLES], DT[N-1]])
-            #ax1.set_xlim([DT[N - DISPLAY_SAMPLES], DT[N-1]])
-            #ax2.set_xlim([DT[N - DISPLAY_SAMPLES], DT[N-1]])
-            ax0.plot(DT[N - DISPLAY_SAMPLES:-1], R[N - DISPLAY_SAMPLES:-1], '.-', color='orange')
-            ax1.plot(DT[N - DISPLAY_SAMPLES:-1], V[N - DISPLAY_SAMPLES:-1], '.-', color='red')
-            ax2.plot(DT[N - DISPLAY_SAMPLES:-1], T[N - DISPLAY_SAMPLES:-1], '.-', color='yellow')
-        else:
-            ax0.plot(DT[:i], R[:i], '.-', color='orange')
-            ax1.plot(DT[:i], V[:i], '.-', color='red')
-            ax2.plot(DT[:i], T[:i], '.-', color='yellow')
-
-        if N > 0:
-            # Rimozione delle annotazioni precedenti
-            for _k, ann_item in enumerate(ann_list):
-                ann_item.remove()
-            ann_list[:] = []
-            ## Annotazioni riportanti gli ultimi valori misurati
-            # Resistenza
-            an0 = ax0.annotate(f'{R[-1]:.3e}', xy=(1.01, 0.9),  xycoords='axes fraction', color="w")
-            # Voltaggio
-            an1 = ax1.annotate(f'{V[-1]:.3e}', xy=(1.01, 0.9),  xycoords='axes fraction', color="w")
-            # Temperatura
-            an2 = ax2.annotate(f'{T[-1]:.2e}', xy=(1.01, 0.9),  xycoords='axes fraction', color="w")
-            ann_list.append(an0)
-            ann_list.append(an1)
-            ann_list.append(an2)
+        live_plot.set_status(metrics.summary())
+        # Solo gli ultimi DISPLAY_SAMPLES punti, copiati sotto il lock del buffer
+        with metrics.stage('plot frame'):
+            live_plot.update(data.window(), len(data))
 
 def on_close(event):
     """ On close plotting window event handler """
     # Trigger measurement thread exit event
     exit_event.set()
     thr_measure.join()
+    temperature_poller.stop()
     date_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    if stream is not None:
+        # Scrittura degli ultimi punti rimasti in coda
+        stream.close()
+    if live is not None:
+        live.close()
     answer = eg.ynbox('Save data?', 'Closing the experiment', ('Yes', 'No'))
-    if answer and len(T) > 0:
-        path = "Esperimenti/" + SAMPLE_NAME + "/" + title.replace(" ", "_")
-        path_file = path + "/" + title.replace(" ", "_") + "-" + date_time
-        try:
-            # Creazione, se non esistente, della cartella base col nome del campione
-            if not os.path.exists("Esperimenti/" + SAMPLE_NAME):
-                os.mkdir("Esperimenti/" + SAMPLE_NAME)
-            # Creazione, se non esistente, della cartella dell'esperimento
-            if not os.path.exists(path):
-                os.mkdir(path)
-            # Create and save README file descriptor
-            logging.info("Save the description file")
-            with open(path_file, "a", encoding='utf-8') as file:
-                file.write(conf['DESCRIPTION'])
-                file.write(f"\nName of the sample: {SAMPLE_NAME}")
-                file.write(f"\nArea: {conf['AREA']}cm2")
-                file.write(f"\nLength: {conf['LENGTH']}cm")
-                if conf.getboolean('SOURCE_FIXED'):
-                    file.write(f"\nCurrent source fixed at {conf['SOURCE_FIXED_VALUE']}A")
-                elif conf.getboolean('SOURCE_SQUARE_WAVE'):
-                    file.write(f"\nCurrent square waveform source, value \
-{conf['SOURCE_SQUARE_VALUE']}A")
-                elif SOURCE_FLIPPED:
-                    file.write(f"\nCurrent source starts and ends at {conf['SOURCE_MIN_VALUE']}A \
-through {conf['SOURCE_MAX_VALUE']}A")
-                else:
-                    file.write(f"\nCurrent source from {conf['SOURCE_MIN_VALUE']}A to \
-{conf['SOURCE_MAX_VALUE']}A")
-                file.write(f'\n\n### Experiment {date_time} ###')
-                file.write(f'\nDate {DT[0].strftime("%Y-%m-%d")} start at \
-{DT[0].strftime("%H:%M:%S")} end at {DT[-1].strftime("%H:%M:%S")} \
-duration {str(DT[-1].replace(microsecond=0)-DT[0].replace(microsecond=0))}')
-                file.write(f'\nTemperature range from {np.min(T):.2f}°K to {np.max(T):.2f}°K')
-                file.write('\nResistivity:')
-                file.write(f'\n\t average {np.average(RHO):.4e}𝛀 cm')
-                file.write(f'\n\t minimum {np.min(RHO):.4e}𝛀 cm at {T[np.argmin(R)]:.2f}°K')
-                file.write(f'\n\t maximum {np.max(RHO):.4e}𝛀 cm at {T[np.argmax(R)]:.2f}°K')
-                file.write('\nResistance:')
-                file.write(f'\n\t average {np.average(R):.4e}𝛀 cm')
-                file.write(f'\n\t minimum {np.min(R):.4e}𝛀 cm')
-                file.write(f'\n\t maximum {np.max(R):.4e}𝛀 cm')
-
-                file.write('\nVoltage:')
-                file.write(f'\n\t average {np.average(V):.4e}V')
-                file.write(f'\n\t minimum {np.min(V):.4e}V at {T[np.argmin(V)]:.2f}°K')
-                file.write(f'\n\t maximum {np.max(V):.4e}V at {T[np.argmax(V)]:.2f}°K')
-                file.write('\n -------------------------------------------------------\n')
-        except OSError as error:
-            logging.error("Error handling description file: %s", error)
-            # print(error)
-
-        # Salvataggio dati formato numpy
-        logging.info("Save data in numpy format %s", path_file)
-        np.savez_compressed(path_file, datetime=DT, temperature=T,
-                            voltage=V, resistance=R, current_source=I,
-                            electric_field=E, current_density=J,
-                            resistivity=RHO)
-
-        # Salvataggio dati formato csv
-        csv_path = path_file + ".csv"
-        logging.info("Save data in CSV format %s", csv_path)
-        data = pd.DataFrame(np.stack((DT, T, V, R, I, E, RHO, J), axis=-1),
-columns=['Datetime', 'Temperature [K]', 'Voltage [V]', 'Resistance [𝛀]', 'Current Source [A]', \
-'Electric Field [V/cm]', 'Restivity [𝛀 cm]', 'Current Density [A/cm2]'])
-        data.to_csv(csv_path, index=False)
-
-        # Salvataggio grafico
-        fig_file = path_file + ".png"
-        logging.info("Save plot as image %s", fig_file)
-        fig.savefig(fig_file)
-    else:
-        logging.info("Data not saved")
-        if len(T) <= 0:
-            logging.warning("Data empty")
-    answer1 = eg.ynbox('Switch off the Source Meter?', 'Closing the experiment', ('Yes', 'No'))
-    if answer1:
-        try:
-            # Turn off source meter output
-            sm.write(':OUTP OFF')
-        except gpib.GpibError:
-            logging.warning("Couldn't turn off the Source Meter")
-            sys.exit(-1)
-    if answer and len(T) > 0:
-        # Copia del log
-        shutil.copy(sys.argv[0].replace('.py', '.log'), path_file + ".log")
+    # Vista senza copia di tutte le misure acquisite
+    history = data.history()
+    saving = None
+    saved = False
+    try:
+        if answer and len(history) > 0:
+            path_file = experiment_io.experiment_file(SAMPLE_NAME, title, date_time)
+            # Descrizione, npz, csv, col e grafico scritti insieme dai thread del pool,
+            # lo spegnimento del Source Meter non attende il disco
+            plot_timer.stop()
+            saving = experiment_io.save_run(save_pool, path_file, conf, history, date_time,
+                                            SOURCE_FLIPPED,
+                                            experiment_io.run_metadata(conf, title, date_time,
+                                                                       SOURCE_FLIPPED),
+                                            figure=fig, run_metrics=metrics)
+        else:
+            logging.info("Data not saved")
+            if len(history) <= 0:
+                logging.warning("Data empty")
+            saved = True
+    except Exception as e:  # pylint: disable=broad-except
+        # Il Source Meter va spento comunque, i dati restano nello stream
+        logging.error("Error saving the data: %s", e)
+    try:
+        answer1 = eg.ynbox('Switch off the Source Meter?', 'Closing the experiment',
+                           ('Yes', 'No'))
+        if answer1:
+            try:
+                # Turn off source meter output
+                sm.write(':OUTP OFF').result()
+            except gpib.GpibError:
+                logging.warning("Couldn't turn off the Source Meter")
+                sys.exit(-1)
+        if saving is not None:
+            saved = experiment_io.wait_run(saving)
+        save_pool.shutdown()
+        if stream is not None:
+            if saved:
+                # Dati salvati o scartati dall'operatore, lo stream non serve più
+                os.remove(stream.path)
+            else:
+                logging.warning("Data stream kept in %s", stream.path)
+        if saving is not None:
+            # Copia del log
+            shutil.copy(sys.argv[0].replace('.py', '.log'), path_file + ".log")
+    finally:
+        bus.close()
     logging.info("Closing the experiment")
     sys.exit(0)
 
-anim = animation.FuncAnimation(plt.gcf(), update_plot, interval=500, blit=False)
+# Pool di thread per il salvataggio dei file alla chiusura
+save_pool = ThreadPoolExecutor(max_workers=5, thread_name_prefix='save')
+
+plot_timer = fig.canvas.new_timer(interval=500)
+plot_timer.add_callback(update_plot)
+plot_timer.start()
 
 # Impostazione dell'evento della chiusura della finestra
 fig.canvas.mpl_connect('close_event', on_close)
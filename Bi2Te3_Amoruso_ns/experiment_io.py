@@ -0,0 +1,204 @@
+'''
+ Output files of an experiment.
+ Every run is saved under Esperimenti/<sample>/<title>/<title>-<datetime>
+ as a description file, a numpy .npz archive, a .csv table and a
+ memory-mappable .col file; the same functions are used at the end of the
+ acquisition and by the recovery tool of the data stream. save_run()
+ writes all of them at the same time on a pool of worker threads.
+'''
+import io
+import os
+import logging
+from concurrent.futures import Future
+import numpy as np
+from column_store import COLUMN_SUFFIX, write_columns
+
+# Cartella base degli esperimenti
+BASE_DIR = "Esperimenti"
+
+# Campi riassunti nel file di descrizione
+SUMMARY_FIELDS = ['temperature', 'voltage', 'resistance', 'resistivity']
+
+# Intestazioni del file csv, nell'ordine delle colonne
+CSV_COLUMNS = [('datetime', 'Datetime'), ('temperature', 'Temperature [K]'),
+               ('voltage', 'Voltage [V]'), ('resistance', 'Resistance [𝛀]'),
+               ('current_source', 'Current Source [A]'),
+               ('electric_field', 'Electric Field [V/cm]'),
+               ('resistivity', 'Restivity [𝛀 cm]'),
+               ('current_density', 'Current Density [A/cm2]'),
+               ('diode_voltage', 'Diode Voltage [V]'),
+               ('voltage_std', 'Voltage Std [V]'),
+               ('temperature_std', 'Temperature Std [K]'),
+               ('n_samples', 'Samples')]
+
+
+def experiment_dir(sample_name, title):
+    """ Directory of the experiment, created if it does not exist """
+    path = os.path.join(BASE_DIR, sample_name, title.replace(" ", "_"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def experiment_file(sample_name, title, date_time):
+    """ Base path, without extension, of the output files of a run """
+    return os.path.join(experiment_dir(sample_name, title),
+                        title.replace(" ", "_") + "-" + date_time)
+
+
+def summary(history):
+    """ Average, minimum, maximum and their indices of the summary fields
+
+    One reduction per statistic over the stacked fields, returned as
+    {field: {'avg', 'min', 'max', 'argmin', 'argmax'}}.
+    """
+    values = np.stack([history[field] for field in SUMMARY_FIELDS])
+    stats = {'avg': np.average(values, axis=1), 'min': np.min(values, axis=1),
+             'max': np.max(values, axis=1), 'argmin': np.argmin(values, axis=1),
+             'argmax': np.argmax(values, axis=1)}
+    return {field: {name: stat[k].item() for name, stat in stats.items()}
+            for k, field in enumerate(SUMMARY_FIELDS)}
+
+
+def write_description(path_file, conf, history, date_time, source_flipped, stats=None):
+    """ Append the description of the run to the README file descriptor """
+    sample_name = conf['SAMPLE_NAME']
+    DT = history[[0, -1]]['datetime'].astype(object)
+    T = history['temperature']
+    if stats is None:
+        stats = summary(history)
+    t, v, r, rho = (stats[field] for field in SUMMARY_FIELDS)
+    logging.info("Save the description file")
+    with open(path_file, "a", encoding='utf-8') as file:
+        file.write(conf['DESCRIPTION'])
+        file.write(f"\nName of the sample: {sample_name}")
+        file.write(f"\nArea: {conf['AREA']}cm2")
+        file.write(f"\nLength: {conf['LENGTH']}cm")
+        if conf.getboolean('SOURCE_FIXED'):
+            file.write(f"\nCurrent source fixed at {conf['SOURCE_FIXED_VALUE']}A")
+        elif conf.getboolean('SOURCE_SQUARE_WAVE'):
+            file.write(f"\nCurrent square waveform source, value \
+{conf['SOURCE_SQUARE_VALUE']}A")
+        elif source_flipped:
+            file.write(f"\nCurrent source starts and ends at {conf['SOURCE_MIN_VALUE']}A \
+through {conf['SOURCE_MAX_VALUE']}A")
+        else:
+            file.write(f"\nCurrent source from {conf['SOURCE_MIN_VALUE']}A to \
+{conf['SOURCE_MAX_VALUE']}A")
+        file.write(f'\n\n### Experiment {date_time} ###')
+        file.write(f'\nDate {DT[0].strftime("%Y-%m-%d")} start at \
+{DT[0].strftime("%H:%M:%S")} end at {DT[-1].strftime("%H:%M:%S")} \
+duration {str(DT[-1].replace(microsecond=0)-DT[0].replace(microsecond=0))}')
+        file.write(f'\nTemperature range from {t["min"]:.2f}°K to {t["max"]:.2f}°K')
+        file.write('\nResistivity:')
+        file.write(f'\n\t average {rho["avg"]:.4e}𝛀 cm')
+        file.write(f'\n\t minimum {rho["min"]:.4e}𝛀 cm at {T[r["argmin"]]:.2f}°K')
+        file.write(f'\n\t maximum {rho["max"]:.4e}𝛀 cm at {T[r["argmax"]]:.2f}°K')
+        file.write('\nResistance:')
+        file.write(f'\n\t average {r["avg"]:.4e}𝛀 cm')
+        file.write(f'\n\t minimum {r["min"]:.4e}𝛀 cm')
+        file.write(f'\n\t maximum {r["max"]:.4e}𝛀 cm')
+
+        file.write('\nVoltage:')
+        file.write(f'\n\t average {v["avg"]:.4e}V')
+        file.write(f'\n\t minimum {v["min"]:.4e}V at {T[v["argmin"]]:.2f}°K')
+        file.write(f'\n\t maximum {v["max"]:.4e}V at {T[v["argmax"]]:.2f}°K')
+        file.write('\n -------------------------------------------------------\n')
+
+
+def save_npz(path_file, history):
+    """ Save the run in numpy format, one array per field """
+    logging.info("Save data in numpy format %s", path_file)
+    # datetime64 nativo: il file si legge senza allow_pickle
+    np.savez_compressed(path_file, **{name: history[name] for name in history.dtype.names})
+
+
+def save_csv(path_file, history):
+    """ Save the run as csv table """
+    # pandas caricato solo al salvataggio, non all'avvio dello script
+    import pandas as pd  # pylint: disable=import-outside-toplevel
+    csv_path = path_file + ".csv"
+    logging.info("Save data in CSV format %s", csv_path)
+    table = pd.DataFrame({header: history[field] for field, header in CSV_COLUMNS})
+    table.to_csv(csv_path, index=False)
+
+
+def source_mode(conf, source_flipped):
+    """ Name of the current source mode of the run """
+    if conf.getboolean('SOURCE_FIXED'):
+        return 'fixed'
+    if conf.getboolean('SOURCE_SQUARE_WAVE'):
+        return 'square'
+    if source_flipped:
+        return 'flipped'
+    return 'ramp'
+
+
+def run_metadata(conf, title, date_time, source_flipped):
+    """ Metadata of the run stored in the header of the .col file """
+    return {'sample': conf['SAMPLE_NAME'], 'title': title, 'date_time': date_time,
+            'area': conf.getfloat('AREA'), 'length': conf.getfloat('LENGTH'),
+            'source_mode': source_mode(conf, source_flipped),
+            'adaptive_sweep': conf.getboolean('ADAPTIVE_SWEEP', fallback=False),
+            'limit': conf.getfloat('LIMIT'), 'description': conf.get('DESCRIPTION', ''),
+            'conf': dict(conf)}
+
+
+def save_columns(path_file, history, metadata):
+    """ Save the run as memory-mappable .col file """
+    col_path = path_file + COLUMN_SUFFIX
+    logging.info("Save data in columnar format %s", col_path)
+    write_columns(col_path, history, metadata)
+
+
+def save_run(pool, path_file, conf, history, date_time, source_flipped, metadata,
+             figure=None, run_metrics=None):
+    """ Submit the writing of every output file of a run to a thread pool
+
+    run_metrics is the metrics.Metrics of the acquisition, saved as
+    .metrics.json. The figure is rendered on the calling thread, matplotlib
+    figures are not thread-safe, only its png is written by the pool.
+    Return {output name: future}; the future of each file raises the error
+    of its writer, so one failed output does not stop the others.
+    """
+    stats = summary(history)
+    futures = {
+        'description': pool.submit(write_description, path_file, conf, history, date_time,
+                                   source_flipped, stats),
+        'npz': pool.submit(save_npz, path_file, history),
+        'csv': pool.submit(save_csv, path_file, history),
+        'col': pool.submit(save_columns, path_file, history, metadata),
+    }
+    if run_metrics is not None:
+        futures['metrics'] = pool.submit(run_metrics.save, path_file)
+    if figure is not None:
+        fig_file = path_file + ".png"
+        logging.info("Save plot as image %s", fig_file)
+        # Rendering mentre il pool scrive gli altri file
+        image = io.BytesIO()
+        try:
+            figure.savefig(image, format='png')
+        except (OSError, ValueError) as error:
+            futures['png'] = Future()
+            futures['png'].set_exception(error)
+        else:
+            futures['png'] = pool.submit(write_bytes, fig_file, image.getvalue())
+    return futures
+
+
+def write_bytes(path, content):
+    """ Write content to the file path """
+    with open(path, 'wb') as file:
+        file.write(content)
+
+
+def wait_run(futures):
+    """ Wait for the outputs of save_run, log the errors, return True if all saved """
+    saved = True
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as error:  # pylint: disable=broad-except
+            # Ogni errore del worker viene riportato, la chiusura continua
+            logging.error("Error saving the %s file: %s", name, error)
+            saved = False
+    return saved
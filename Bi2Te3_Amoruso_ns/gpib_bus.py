@@ -0,0 +1,133 @@
+'''
+ Single owner of the GPIB bus.
+ All the instrument transactions go through one I/O thread serving a
+ priority queue, so write/read pairs of different threads never interleave.
+ Every request returns a concurrent.futures.Future: the caller decides
+ whether to wait for the answer or carry on.
+'''
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from metrics import TimedHandle
+
+# Priorità delle richieste, il valore più basso è servito per primo
+MEASURE = 0
+NORMAL = 5
+POLL = 10
+PRIORITY_NAMES = {MEASURE: 'measure', NORMAL: 'normal', POLL: 'poll'}
+
+
+class GpibBus:
+    """ I/O thread owning every instrument handle on the bus
+
+    With a metrics.Metrics the time every request waits in the queue is
+    recorded by priority, and the handles of device() time their I/O.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._queue = queue.PriorityQueue()
+        # Contatore per mantenere l'ordine di arrivo a parità di priorità
+        self._seq = itertools.count()
+        self._thread = threading.Thread(target=self._run, name='gpib-bus', daemon=True)
+        self._thread.start()
+
+    def device(self, handle, name='gpib'):
+        """ Wrap a Gpib handle, its I/O will run on the bus thread """
+        if self.metrics is not None:
+            handle = TimedHandle(handle, self.metrics, name)
+        return BusDevice(self, handle)
+
+    def submit(self, function, priority=NORMAL):
+        """ Run function() on the bus thread, return its Future """
+        future = Future()
+        self._queue.put((priority, next(self._seq), function, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        """ Serve the requests already queued, then stop the thread """
+        self._queue.put((float('inf'), next(self._seq), None, None, None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            priority, _seq, function, future, queued = self._queue.get()
+            if function is None:
+                break
+            if self.metrics is not None:
+                # Attesa in coda: contesa del bus fra misura, GUI e poller
+                self.metrics.record(f'bus wait {PRIORITY_NAMES.get(priority, priority)}',
+                                    time.perf_counter() - queued)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function())
+            except Exception as error:  # pylint: disable=broad-except
+                # Rilanciata al chiamante da future.result()
+                future.set_exception(error)
+
+
+class BusDevice:
+    """ Non-blocking client of one instrument on the bus """
+
+    def __init__(self, bus, handle):
+        self.bus = bus
+        self.handle = handle
+
+    def write(self, command, priority=NORMAL):
+        """ Send a command, the Future result is None """
+        return self.bus.submit(lambda: self.handle.write(command), priority)
+
+    def read(self, length=512, priority=NORMAL):
+        """ Read an answer, the Future result is bytes """
+        return self.bus.submit(lambda: self.handle.read(length), priority)
+
+    def query(self, command, length=512, priority=NORMAL):
+        """ Write a command and read its answer as a single transaction """
+        def transaction():
+            self.handle.write(command)
+            return self.handle.read(length)
+        return self.bus.submit(transaction, priority)
+
+
+class Poller:
+    """ Periodic low priority query, the last answer is kept for the GUI """
+
+    def __init__(self, device, command, interval, enabled=lambda: True, priority=POLL):
+        self.device = device
+        self.command = command
+        self.interval = interval
+        self.enabled = enabled
+        self.priority = priority
+        self._lock = threading.Lock()
+        self._value = None
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='gpib-poller', daemon=True)
+        self._thread.start()
+
+    def take(self):
+        """ Return (answer, error) received since the last call """
+        with self._lock:
+            value, error = self._value, self._error
+            self._value = self._error = None
+        return value, error
+
+    def stop(self):
+        """ Stop polling """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.enabled():
+                future = self.device.query(self.command, priority=self.priority)
+                try:
+                    value, error = future.result(), None
+                except Exception as exc:  # pylint: disable=broad-except
+                    value, error = None, exc
+                with self._lock:
+                    self._value, self._error = value, error
+            self._stop.wait(self.interval)
@@ -0,0 +1,168 @@
+'''
+ Bring-up of the instruments of the bench on the GPIB bus owner thread.
+ Keithley 2700 multimeter (address 16) reading the thermometer diode,
+ Keithley 2182A nanovoltmeter (address 7) on channel 1 and Keithley 2400
+ source meter (address 24) as current source.
+ bring_up() resets and configures the three instruments together: the
+ resets run inside the instruments at the same time and the configuration
+ commands are queued on the bus without waiting for each answer. With the
+ warm start an instrument whose settings already match the configuration
+ is not reset nor configured again.
+'''
+import logging
+import gpib
+import Gpib
+import acquisition
+
+# Indirizzi GPIB degli strumenti
+MULTIMETER_PAD = 16
+NANOVOLT_PAD = 7
+SOURCEMETER_PAD = 24
+
+# Configurazione dopo il reset di ciascuno strumento
+MULTIMETER_SETUP = [
+    # Select source function, mode Voltage reading only.
+    ":SENS:FUNC 'VOLT'",
+    # CHANNEL 1
+    ":FORM:ELEM READ",
+]
+NANOVOLT_SETUP = [
+    # Select source function, mode Voltage reading only.
+    ":SENS:FUNC 'VOLT'",
+    # CHANNEL 1
+    ":SENS:CHAN 1",
+]
+SOURCEMETER_SETUP = [
+    # Select current source.
+    ":SOUR:FUNC CURR",
+    # Select source range.
+    #":SOUR:CURR:RANG 10E-3",
+    # Voltage measure function.
+    ":SENS:FUNC 'VOLT'",
+    # Voltage reading only.
+    ":FORM:ELEM VOLT",
+]
+
+# Stato verificato dal warm start: query e risposte accettate, senza
+# virgolette e in maiuscolo; include quanto lasciato dalla rampa bufferizzata
+MULTIMETER_STATE = [
+    (':SENS:FUNC?', ('VOLT', 'VOLT:DC')),
+    (':FORM:ELEM?', ('READ',)),
+]
+NANOVOLT_STATE = [
+    (':SENS:FUNC?', ('VOLT', 'VOLT:DC')),
+    (':SENS:CHAN?', ('1',)),
+    (':TRIG:SOUR?', ('IMM',)),
+    (':FORM:DATA?', ('ASC',)),
+]
+SOURCEMETER_STATE = [
+    (':SOUR:FUNC?', ('CURR',)),
+    (':SENS:FUNC?', ('VOLT', 'VOLT:DC')),
+    (':FORM:ELEM?', ('VOLT',)),
+    (':SOUR:CURR:MODE?', ('FIX', 'FIXED')),
+]
+
+# Strumenti del banco: nome, indirizzo, configurazione, stato
+BENCH = [
+    ('Multimeter', MULTIMETER_PAD, MULTIMETER_SETUP, MULTIMETER_STATE),
+    ('Nanovolt meter', NANOVOLT_PAD, NANOVOLT_SETUP, NANOVOLT_STATE),
+    ('Source meter', SOURCEMETER_PAD, SOURCEMETER_SETUP, SOURCEMETER_STATE),
+]
+
+
+class BringUpError(Exception):
+    """ GPIB error of one instrument during the bring-up """
+
+    def __init__(self, instrument, error):
+        super().__init__(f"{instrument}: {error}")
+        self.instrument = instrument
+        self.error = error
+
+
+def state_matches(answer, state):
+    """ True if the answer of the compound state query agrees with state """
+    values = answer.strip().split(';')
+    return len(values) == len(state) and all(
+        value.strip().replace('"', '').replace("'", '').upper() in accepted
+        for value, (_query, accepted) in zip(values, state))
+
+
+def _result(instrument, futures):
+    """ Wait for the futures of one instrument, return the last result """
+    result = None
+    try:
+        for future in futures:
+            result = future.result()
+    except gpib.GpibError as e:
+        raise BringUpError(instrument, e) from e
+    return result
+
+
+def bring_up(bus, current, limit, warm=False, board=0):
+    """ Configure the bench, return the (multimeter, nanovolt, sm) bus devices
+
+    The source meter sources current [A] with voltage compliance limit [V];
+    its output is turned on only when all the instruments answered.
+    BringUpError names the instrument that does not respond.
+    """
+    devices = {}
+    for instrument, pad, _setup, _state in BENCH:
+        try:
+            devices[instrument] = bus.device(Gpib.Gpib(board, pad), instrument)
+        except gpib.GpibError as e:
+            raise BringUpError(instrument, e) from e
+
+    # Warm start: identificazione e stato in un'unica query per strumento
+    ready = {}
+    if warm:
+        queries = {}
+        for instrument, _pad, _setup, state in BENCH:
+            queries[instrument] = devices[instrument].query(
+                ';'.join(['*IDN?'] + [query for query, _accepted in state]))
+        for instrument, _pad, _setup, state in BENCH:
+            idn, _, answer = _result(instrument, [queries[instrument]]).decode(
+                "utf-8").partition(';')
+            if state_matches(answer, state):
+                ready[instrument] = idn.strip()
+            else:
+                logging.info('%s settings changed, reset', instrument)
+
+    # Reset GPIB defaults, tutti insieme: ogni strumento si resetta per conto suo
+    pending = {instrument: [] if instrument in ready else [devices[instrument].write("*RST")]
+               for instrument, *_ in BENCH}
+    identify = {}
+    for instrument, _pad, setup, _state in BENCH:
+        if instrument not in ready:
+            # Identify request and read answer
+            identify[instrument] = devices[instrument].query("*IDN?")
+            pending[instrument].extend(devices[instrument].write(command)
+                                       for command in setup)
+    sm = devices['Source meter']
+    # Source output.
+    pending['Source meter'].append(sm.write(f":SOUR:CURR:LEV {current}"))
+    # Voltage compliance.
+    pending['Source meter'].append(sm.write(f':SENS:VOLT:PROT {limit}'))
+
+    for instrument, *_ in BENCH:
+        if instrument in ready:
+            logging.info('Found %s %s (warm start)', instrument, ready[instrument])
+        else:
+            idn = _result(instrument, [identify[instrument]])
+            logging.info('Found %s %s', instrument, idn.decode("utf-8"))
+        _result(instrument, pending[instrument])
+
+    # Turn on source meter output
+    _result('Source meter', [sm.write(":OUTP ON")])
+    return devices['Multimeter'], devices['Nanovolt meter'], sm
+
+
+def select_reader(nanovolt, multimeter, concurrent):
+    """ Reading function of the two meters, concurrent when possible """
+    if concurrent:
+        try:
+            acquisition.setup_concurrent(nanovolt, multimeter)
+            logging.info('Concurrent reading of nanovolt meter and multimeter')
+            return acquisition.read_concurrent
+        except gpib.GpibError as e:
+            logging.warning("Concurrent reading not available, reading in sequence: %s", e)
+    return acquisition.read_sequential
@@ -0,0 +1,138 @@
+'''
+ Incremental live plot of the measurement window.
+ The lines are created once and updated with set_data, the figure
+ background is cached and only the changing artists are blitted.
+ When the window holds more points than the axes has pixels the data is
+ min/max decimated, so the cost of a frame does not depend on the length
+ of the experiment.
+'''
+import numpy as np
+from matplotlib import dates as mdates
+
+# Margine aggiunto ai limiti quando i dati escono dal grafico
+Y_MARGIN = 0.1
+# Spazio lasciato a destra sull'asse dei tempi
+X_HEADROOM = 0.2
+
+
+def minmax_decimate(x, y, buckets):
+    """ Reduce (x, y) to the min and max of y over `buckets` equal slices
+
+    The extremes of every slice are kept in their original order, so spikes
+    and oscillations remain visible at any zoom level.
+    """
+    n = len(y)
+    if buckets <= 0 or n <= 2 * buckets:
+        return x, y
+    size = n // buckets
+    used = size * buckets
+    slices = y[:used].reshape(buckets, size)
+    # I valori non finiti (R a corrente nulla) non devono vincere il confronto
+    finite = np.where(np.isfinite(slices), slices, np.nan)
+    all_nan = np.all(np.isnan(finite), axis=1)
+    finite[all_nan] = 0.0
+    i_min = np.nanargmin(finite, axis=1)
+    i_max = np.nanargmax(finite, axis=1)
+    base = np.arange(buckets) * size
+    idx = np.empty(2 * buckets, dtype=np.intp)
+    idx[0::2] = np.minimum(i_min, i_max) + base
+    idx[1::2] = np.maximum(i_min, i_max) + base
+    idx = np.concatenate((idx, np.arange(used, n)))
+    return x[idx], y[idx]
+
+
+def _finite_range(values):
+    """ (min, max) of the finite values, None if there are none """
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return None
+    return finite.min(), finite.max()
+
+
+class LivePlot:
+    """ Persistent artists for the live measurement plot
+
+    series is a list of (axes, field, color, annotation format) tuples, one
+    line per axes, plotted against the 'datetime' field of the window.
+    """
+
+    def __init__(self, fig, series, blit=True):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.blit = blit and self.canvas.supports_blit
+        self._background = None
+        self._total = 0
+        self._series = []
+        for ax, field, color, fmt in series:
+            ax.xaxis_date()
+            line, = ax.plot([], [], '.-', color=color, animated=self.blit)
+            # Annotazione riportante l'ultimo valore misurato
+            ann = ax.annotate('', xy=(1.01, 0.9), xycoords='axes fraction',
+                              color='w', animated=self.blit)
+            self._series.append((ax, field, fmt, line, ann))
+        # Riga di stato in basso, ridisegnata con le linee
+        self._status = fig.text(0.01, 0.005, '', color='w', fontsize='small',
+                                animated=self.blit)
+        if self.blit:
+            self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _artists(self):
+        for _ax, _field, _fmt, line, ann in self._series:
+            yield line
+            yield ann
+        yield self._status
+
+    def set_status(self, text):
+        """ Text of the status line, shown at the next update """
+        self._status.set_text(text)
+
+    def _on_draw(self, _event):
+        """ Cache the static background after every full redraw """
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self._artists():
+            self.fig.draw_artist(artist)
+
+    def _rescale(self, ax, x, y):
+        """ Move the limits only when the data leaves them, True if changed """
+        changed = False
+        x0, x1 = ax.get_xlim()
+        # Anche quando la finestra scorre e lascia vuota la parte sinistra
+        if len(x) > 0 and (x[0] < x0 or x[-1] > x1 or x[0] > x0 + (x1 - x0) * 0.25):
+            span = max(x[-1] - x[0], 1.0 / 86400)
+            ax.set_xlim(x[0], x[-1] + span * X_HEADROOM)
+            changed = True
+        y_range = _finite_range(y)
+        if y_range is not None:
+            low, high = y_range
+            y0, y1 = ax.get_ylim()
+            span = high - low
+            # Ridimensionamento anche quando i dati occupano troppo poco spazio
+            if low < y0 or high > y1 or (span > 0 and span < (y1 - y0) * 0.25):
+                margin = span * Y_MARGIN if span > 0 else max(abs(high) * Y_MARGIN, 1e-12)
+                ax.set_ylim(low - margin, high + margin)
+                changed = True
+        return changed
+
+    def update(self, window, total):
+        """ Draw the window of measurements, total is the number of points
+        acquired so far and is used to skip frames without new data """
+        if len(window) == 0 or total == self._total:
+            return
+        self._total = total
+        x = mdates.date2num(window['datetime'])
+        rescaled = False
+        for ax, field, fmt, line, ann in self._series:
+            buckets = int(ax.bbox.width)
+            x_dec, y_dec = minmax_decimate(x, window[field], buckets)
+            line.set_data(x_dec, y_dec)
+            ann.set_text(fmt.format(window[field][-1]))
+            rescaled |= self._rescale(ax, x_dec, y_dec)
+
+        if not self.blit or rescaled or self._background is None:
+            # Ridisegno completo: al draw_event viene aggiornato lo sfondo
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        for artist in self._artists():
+            self.fig.draw_artist(artist)
+        self.canvas.blit(self.fig.bbox)
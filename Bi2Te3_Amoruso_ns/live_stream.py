@@ -0,0 +1,292 @@
+'''
+ Live stream of the measurements to local subscribers, e.g. notebooks.
+ The measurement thread hands the points to a LivePublisher without ever
+ waiting: a publisher thread packs them in binary batches of LIVE_FIELDS
+ and a sender thread per subscriber writes them on its TCP connection.
+ Backpressure is taken by the subscribers: each one has at most
+ max_pending batches in flight, when a slow client falls behind its
+ oldest batches are discarded and it receives a gap frame with the number
+ of rows lost. The complete data is always in the buffer and in the
+ crash-safe stream on disk, the live stream only feeds the plots.
+
+ Frames, all starting with a magic, a count and a crc32 (uint32):
+   HEAD, length of the JSON header (run metadata and row dtype), header;
+   CHNK, number of rows, raw rows;
+   GAPS, number of rows discarded for this subscriber, 0.
+ A subscriber first receives the header of the current run and its last
+ backlog rows; a new HEAD starts a new run (queued sweeps).
+'''
+import collections
+import json
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+HEAD_MAGIC = b'HEAD'
+CHUNK_MAGIC = b'CHNK'
+GAP_MAGIC = b'GAPS'
+_FRAME = struct.Struct('<4sII')
+
+# Indirizzo predefinito del server, solo locale
+LIVE_HOST = '127.0.0.1'
+LIVE_PORT = 5757
+# Campi inviati ai client, (datetime, T, V, I, R)
+LIVE_FIELDS = ['datetime', 'temperature', 'voltage', 'current_source', 'resistance']
+# Segnaposto in coda dell'inizio di un nuovo run
+_NEW_RUN = object()
+
+
+def frame(magic, count, payload=b''):
+    """ Encoded frame with the crc32 of the payload """
+    return _FRAME.pack(magic, count, zlib.crc32(payload)) + payload
+
+
+class _Subscriber:
+    """ Connection of one client with its bounded queue of frames """
+
+    def __init__(self, connection, address, max_pending):
+        self.connection = connection
+        self.address = address
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.closed = False
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f'live-{address[1]}',
+                                        daemon=True)
+        self._thread.start()
+
+    def send(self, payload, rows=0, head=False):
+        """ Queue a frame; when full the oldest batch is discarded, never a header """
+        with self._ready:
+            if head:
+                self.pending.clear()
+                self.dropped = 0
+            elif len(self.pending) >= self.max_pending:
+                _old, old_rows, _old_head = self.pending.popleft()
+                self.dropped += old_rows
+            self.pending.append((payload, rows, head))
+            self._ready.notify()
+
+    def close(self):
+        """ Send the queued frames and close the connection """
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+        self._thread.join()
+
+    def _run(self):
+        """ Sender thread, blocks on the socket of its client only """
+        try:
+            while True:
+                with self._ready:
+                    while not self.pending and not self.closed:
+                        self._ready.wait()
+                    if not self.pending:
+                        break
+                    payload, _rows, _head = self.pending.popleft()
+                    dropped, self.dropped = self.dropped, 0
+                if dropped:
+                    self.connection.sendall(frame(GAP_MAGIC, dropped))
+                self.connection.sendall(payload)
+        except OSError as e:
+            logging.info("Live subscriber %s:%d disconnected: %s", *self.address, e)
+        finally:
+            self.closed = True
+            self.connection.close()
+
+
+class LivePublisher:
+    """ TCP server publishing the measurement rows while they are acquired
+
+    append() and extend() have the interface of StreamWriter and never
+    block the caller: rows go through a bounded queue and are sent in
+    batches of batch_size rows, or every flush_interval seconds.
+    """
+
+    def __init__(self, header, host=LIVE_HOST, port=LIVE_PORT, batch_size=8,
+                 flush_interval=0.5, backlog=4096, max_pending=64, max_queue=100000):
+        self.dtype = np.dtype([(name, 'M8[us]' if name == 'datetime' else 'f8')
+                               for name in LIVE_FIELDS])
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._subscribers = []
+        # Ultime righe del run, inviate ai nuovi client
+        self._backlog = collections.deque(maxlen=max(backlog, 1))
+        self._head = self._encode_head(header)
+        self._server = socket.create_server((host, port))
+        self.address = self._server.getsockname()[:2]
+        self._accept_thread = threading.Thread(target=self._accept, name='live-accept',
+                                               daemon=True)
+        self._accept_thread.start()
+        self._thread = threading.Thread(target=self._run, name='live-publisher', daemon=True)
+        self._thread.start()
+        logging.info("Live stream on %s:%d", *self.address)
+
+    def _encode_head(self, header):
+        header = dict(header, dtype=np.lib.format.dtype_to_descr(self.dtype))
+        encoded = json.dumps(header, default=str).encode('utf-8')
+        return frame(HEAD_MAGIC, len(encoded), encoded)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning("Live stream queue full, point not published")
+
+    def append(self, **values):
+        """ Queue one row, extra fields are ignored """
+        self._put(tuple(values[name] for name in LIVE_FIELDS))
+
+    def extend(self, rows):
+        """ Queue every row of a structured array with the LIVE_FIELDS """
+        for row in rows[LIVE_FIELDS].tolist():
+            self._put(row)
+
+    def new_run(self, header):
+        """ Start a new run: the subscribers receive its header and its rows only """
+        self._put((_NEW_RUN, header))
+
+    def subscribers(self):
+        """ Number of connected clients """
+        with self._lock:
+            self._subscribers = [sub for sub in self._subscribers if not sub.closed]
+            return len(self._subscribers)
+
+    def close(self):
+        """ Publish the pending rows, then close the server and the connections """
+        self._queue.put(None)
+        self._thread.join()
+        self._server.close()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def _accept(self):
+        """ Accept thread, a new client gets the header and the backlog """
+        while True:
+            try:
+                connection, address = self._server.accept()
+            except OSError:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = _Subscriber(connection, address, self.max_pending)
+            with self._lock:
+                subscriber.send(self._head, head=True)
+                if self._backlog:
+                    rows = np.array(list(self._backlog), dtype=self.dtype)
+                    subscriber.send(frame(CHUNK_MAGIC, len(rows), rows.tobytes()), len(rows))
+                self._subscribers.append(subscriber)
+            logging.info("Live subscriber %s:%d connected", *address)
+
+    def _publish(self, rows):
+        payload = np.array(rows, dtype=self.dtype).tobytes()
+        encoded = frame(CHUNK_MAGIC, len(rows), payload)
+        with self._lock:
+            self._backlog.extend(rows)
+            self._subscribers = [sub for sub in self._subscribers if not sub.closed]
+            for subscriber in self._subscribers:
+                subscriber.send(encoded, len(rows))
+
+    def _run(self):
+        """ Publisher thread, batches the queued rows """
+        rows = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(deadline - time.monotonic(), 0.0)
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                row = ()
+            if row is None or (row and row[0] is _NEW_RUN):
+                if rows:
+                    self._publish(rows)
+                    rows = []
+                if row is None:
+                    break
+                with self._lock:
+                    self._head = self._encode_head(row[1])
+                    self._backlog.clear()
+                    for subscriber in self._subscribers:
+                        subscriber.send(self._head, head=True)
+                continue
+            if row:
+                rows.append(row)
+            if len(rows) >= self.batch_size or (rows and time.monotonic() >= deadline):
+                self._publish(rows)
+                rows = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+
+class LiveSubscriber:
+    """ Client of a LivePublisher, iterating over (header, rows) batches
+
+    header is the run metadata, rows a structured array; a batch with a
+    new header and no rows marks the start of a new run. gaps counts the
+    rows the publisher discarded because this client was too slow.
+    """
+
+    def __init__(self, host=LIVE_HOST, port=LIVE_PORT, timeout=None):
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self.header = None
+        self.dtype = None
+        self.gaps = 0
+
+    def _receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise EOFError('live stream closed')
+            data.extend(chunk)
+        return bytes(data)
+
+    def read(self):
+        """ Next (header, rows), None when the publisher closes the stream """
+        while True:
+            try:
+                magic, count, crc = _FRAME.unpack(self._receive(_FRAME.size))
+                if magic == GAP_MAGIC:
+                    self.gaps += count
+                    continue
+                size = count if magic == HEAD_MAGIC else count * self.dtype.itemsize
+                payload = self._receive(size)
+            except (EOFError, OSError):
+                return None
+            if magic not in (HEAD_MAGIC, CHUNK_MAGIC) or zlib.crc32(payload) != crc:
+                raise ValueError('corrupted live stream frame')
+            if magic == HEAD_MAGIC:
+                self.header = json.loads(payload.decode('utf-8'))
+                self.dtype = np.lib.format.descr_to_dtype(
+                    [tuple(field) for field in self.header['dtype']])
+                return self.header, np.empty(0, dtype=self.dtype)
+            return self.header, np.frombuffer(payload, dtype=self.dtype)
+
+    def __iter__(self):
+        while True:
+            batch = self.read()
+            if batch is None:
+                return
+            yield batch
+
+    def close(self):
+        """ Close the connection """
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
@@ -0,0 +1,106 @@
+'''
+ Compact storage for the live measurement arrays.
+ The whole history lives in a growable NumPy structured array, while the
+ last samples shown on the plot are mirrored in a fixed size ring so the
+ display window is always one contiguous slice, copied in a single step.
+'''
+import threading
+import numpy as np
+
+# Campi di una misura, nello stesso ordine dei file salvati
+MEASURE_DTYPE = np.dtype([
+    ('datetime', 'datetime64[us]'),
+    ('temperature', 'f8'),
+    ('voltage', 'f8'),
+    ('resistance', 'f8'),
+    ('current_source', 'f8'),
+    ('electric_field', 'f8'),
+    ('current_density', 'f8'),
+    ('resistivity', 'f8'),
+    ('diode_voltage', 'f8'),
+    ('voltage_std', 'f8'),
+    ('temperature_std', 'f8'),
+    ('n_samples', 'i8'),
+])
+
+
+class MeasureBuffer:
+    """ Thread-safe, append-only buffer of measurement points
+
+    The measurement thread calls append(), the GUI and the save handler read
+    through window() and history(). Rows already written in the history are
+    never modified, so its views stay valid while the buffer keeps growing;
+    the ring is overwritten, so window() returns a copy.
+    """
+
+    def __init__(self, display_samples, capacity=4096, dtype=MEASURE_DTYPE):
+        self._lock = threading.Lock()
+        self._fields = dtype.names
+        self._data = np.empty(max(capacity, 1), dtype=dtype)
+        self._size = 0
+        self._ring_size = max(display_samples, 1)
+        # Ogni punto è scritto due volte nel ring: la finestra degli ultimi
+        # ring_size punti è sempre una fetta contigua e ordinata
+        self._ring = np.empty(2 * self._ring_size, dtype=dtype)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dtype(self):
+        """ Structured dtype of the stored rows """
+        return self._data.dtype
+
+    def append(self, **values):
+        """ Append one measurement point, one keyword per field """
+        row = tuple(values[name] for name in self._fields)
+        with self._lock:
+            if self._size == len(self._data):
+                # Raddoppio della capacità, costo ammortizzato costante
+                grown = np.empty(2 * len(self._data), dtype=self._data.dtype)
+                grown[:self._size] = self._data
+                self._data = grown
+            self._data[self._size] = row
+            pos = self._size % self._ring_size
+            self._ring[pos] = row
+            self._ring[pos + self._ring_size] = row
+            self._size += 1
+
+    def extend(self, rows):
+        """ Append a structured array of points with the buffer dtype """
+        with self._lock:
+            needed = self._size + len(rows)
+            if needed > len(self._data):
+                grown = np.empty(max(2 * len(self._data), needed), dtype=self._data.dtype)
+                grown[:self._size] = self._data[:self._size]
+                self._data = grown
+            self._data[self._size:needed] = rows
+            # Solo gli ultimi ring_size punti finiscono nel ring
+            index = np.arange(max(self._size, needed - self._ring_size), needed)
+            pos = index % self._ring_size
+            self._ring[pos] = rows[index - self._size]
+            self._ring[pos + self._ring_size] = rows[index - self._size]
+            self._size = needed
+
+    def history(self):
+        """ Zero-copy view of every point acquired so far """
+        with self._lock:
+            return self._data[:self._size]
+
+    def window(self):
+        """ Copy of the last display_samples points, oldest first
+
+        The copy is taken under the lock, a frame never mixes old and new rows.
+        """
+        with self._lock:
+            if self._size < self._ring_size:
+                return self._ring[:self._size].copy()
+            start = self._size % self._ring_size
+            return self._ring[start:start + self._ring_size].copy()
+
+    def last(self):
+        """ Most recent point, None if the buffer is empty """
+        with self._lock:
+            if self._size == 0:
+                return None
+            return self._data[self._size - 1].copy()
@@ -0,0 +1,217 @@
+'''
+ Low overhead instrumentation of the acquisition.
+ Latencies are counted in fixed logarithmic histograms and events in plain
+ counters, so recording costs the same at the first and at the millionth
+ point and the memory does not grow with the run. The GPIB handles are
+ wrapped by TimedHandle (one histogram per command), the bus records how
+ long every request waits in its queue, the script records the stages of
+ the measurement loop and of the plot frame. At the end of a run the
+ metrics are written next to its files as <title>-<datetime>.metrics.json.
+'''
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_SUFFIX = '.metrics.json'
+# Istogrammi logaritmici da 1 µs a 1000 s, BINS_PER_DECADE intervalli per decade
+HIST_MIN = 1e-6
+HIST_DECADES = 9
+BINS_PER_DECADE = 10
+
+
+class LatencyHistogram:
+    """ Counts of latencies [s] in logarithmic bins, with count, sum, min and max """
+
+    def __init__(self):
+        # Primo intervallo sotto HIST_MIN, ultimo sopra il massimo
+        self.counts = [0] * (HIST_DECADES * BINS_PER_DECADE + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    @staticmethod
+    def upper_edge(index):
+        """ Upper edge [s] of a bin """
+        return HIST_MIN * 10 ** (index / BINS_PER_DECADE)
+
+    def record(self, seconds):
+        """ Add one latency """
+        if seconds > HIST_MIN:
+            index = min(int(math.log10(seconds / HIST_MIN) * BINS_PER_DECADE) + 1,
+                        len(self.counts) - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """ Upper bound [s] of the q-th percentile, NaN when empty """
+        if self.count == 0:
+            return math.nan
+        rank = q / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(self.upper_edge(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        """ Summary in ms and the non empty bins as [upper edge s, count] """
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1e3,
+            'min_ms': self.min * 1e3,
+            'max_ms': self.max * 1e3,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p90_ms': self.percentile(90) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+            'bins': [[self.upper_edge(index), count]
+                     for index, count in enumerate(self.counts) if count],
+        }
+
+
+class Metrics:
+    """ Latency histograms and counters shared by the threads of a run """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # Istanti del primo e dell'ultimo incremento di ogni contatore
+        self._span = {}
+        self.started = time.monotonic()
+
+    def reset(self):
+        """ Start a new run with empty histograms and counters """
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self._span = {}
+            self.started = time.monotonic()
+
+    def detach(self):
+        """ Metrics of the run so far, while this object starts again empty """
+        run = Metrics()
+        with self._lock:
+            run.histograms, run.counters, run._span = self.histograms, self.counters, self._span
+            run.started = self.started
+            self.histograms = {}
+            self.counters = {}
+            self._span = {}
+            self.started = time.monotonic()
+        return run
+
+    def record(self, name, seconds):
+        """ Add a latency [s] to the histogram name """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def count(self, name, n=1):
+        """ Increment the counter name """
+        now = time.monotonic()
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            self._span[name] = (self._span.get(name, (now,))[0], now)
+
+    def _rate(self, name):
+        count = self.counters.get(name, 0)
+        first, last = self._span.get(name, (0.0, 0.0))
+        return (count - 1) / (last - first) if count > 1 and last > first else 0.0
+
+    def rate(self, name):
+        """ Increments per second of a counter, between its first and last """
+        with self._lock:
+            return self._rate(name)
+
+    @contextmanager
+    def stage(self, name):
+        """ Record the duration of the with block, also when it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def elapsed(self):
+        """ Seconds since the start of the run """
+        return time.monotonic() - self.started
+
+    def summary(self):
+        """ One line summary for the plot window, stages as p50/p99 """
+        with self._lock:
+            counters = dict(self.counters)
+            rate = self._rate('points')
+            stages = [(name, histogram.percentile(50), histogram.percentile(99))
+                      for name, histogram in self.histograms.items()
+                      if name.startswith(('loop ', 'plot '))]
+        text = (f"{rate:.2f} pts/s  "
+                f"GPIB errors {counters.get('gpib errors', 0)}  "
+                f"lost {counters.get('lost points', 0)}  "
+                f"compliance {counters.get('compliance', 0)}")
+        for name, p50, p99 in stages:
+            text += f"  {name.split(' ', 1)[1]} {p50 * 1e3:.0f}/{p99 * 1e3:.0f}ms"
+        return text
+
+    def as_dict(self):
+        """ Counters, rates and histograms, ready for json """
+        with self._lock:
+            return {
+                'seconds': self.elapsed(),
+                'points_per_second': self._rate('points'),
+                'counters': dict(self.counters),
+                'latency': {name: histogram.as_dict()
+                            for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def save(self, path_file):
+        """ Write the metrics of the run as path_file.metrics.json """
+        with open(path_file + METRICS_SUFFIX, 'w', encoding='utf-8') as file:
+            json.dump(self.as_dict(), file, indent=1)
+
+
+class TimedHandle:
+    """ Gpib handle recording the latency of every write and read
+
+    Histograms are named '<instrument> write <command>' and
+    '<instrument> read <command>', the read after the command that asked
+    for the answer; any error of the handle is counted as 'gpib errors'.
+    """
+
+    def __init__(self, handle, metrics, name):
+        self.handle = handle
+        self.metrics = metrics
+        self.name = name
+        self._command = ''
+
+    def _timed(self, operation, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        except Exception:
+            self.metrics.count('gpib errors')
+            self.metrics.count(f'{self.name} errors')
+            raise
+        finally:
+            self.metrics.record(f'{self.name} {operation} {self._command}',
+                                time.perf_counter() - start)
+
+    def write(self, command):
+        """ Gpib.write """
+        self._command = command.split(' ', 1)[0]
+        return self._timed('write', self.handle.write, command)
+
+    def read(self, length=512):
+        """ Gpib.read """
+        return self._timed('read', self.handle.read, length)
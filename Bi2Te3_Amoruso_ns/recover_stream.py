@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+'''
+ Recovery of an interrupted experiment.
+ Turns a (possibly truncated) .stream file left by the acquisition into the
+ usual description, .npz, .csv and .col files, saved next to the stream.
+
+ Usage: recover_stream.py <file.stream> [<file.stream> ...]
+'''
+import configparser
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import experiment_io
+from stream_writer import STREAM_SUFFIX, read_stream
+
+
+def recover(stream_path):
+    """ Write description, npz, csv and col files of a stream, return the rows """
+    header, history = read_stream(stream_path)
+    if len(history) == 0:
+        logging.warning("No data in %s", stream_path)
+        return history
+    # Configurazione dell'esperimento salvata nell'intestazione dello stream
+    config = configparser.ConfigParser()
+    config.read_dict({'DEFAULT': header['conf']})
+    conf = config['DEFAULT']
+    path_file = stream_path[:-len(STREAM_SUFFIX)] if stream_path.endswith(STREAM_SUFFIX) \
+        else stream_path
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        experiment_io.wait_run(experiment_io.save_run(
+            pool, path_file, conf, history, header['date_time'], header['source_flipped'],
+            experiment_io.run_metadata(conf, header['title'], header['date_time'],
+                                       header['source_flipped'])))
+    return history
+
+
+def main(paths):
+    """ Recover every stream given on the command line """
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.INFO)
+    for path in paths:
+        rows = recover(path)
+        print(f"{path}: recovered {len(rows)} points")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(-1)
+    main(sys.argv[1:])
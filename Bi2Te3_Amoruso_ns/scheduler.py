@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+'''
+ Unattended batch of current sweeps.
+ Runs a queue of sweeps back to back on a single instrument session,
+ without dialogs or plot window. Each sweep starts when the temperature
+ enters its band, or after MAX_WAIT seconds, and is saved as the runs of
+ the acquisition script under Esperimenti/<sample>/<title>.
+
+ The queue is an .ini file: the DEFAULT section holds the usual options
+ of exp_ec_i_sourceAG.ini, every other section is a sweep overriding
+ them, in the order of the file, plus:
+   SETPOINT     temperature [K] at which the sweep starts (none: at once)
+   BAND         half width of the band around SETPOINT [K], default 1
+   T_MIN, T_MAX band limits [K], alternative to SETPOINT and BAND
+   STABLE_TIME  time the temperature must stay in the band [s], default 0
+   MAX_WAIT     longest wait for the band [s], default 3600
+   ON_TIMEOUT   'skip' or 'run' the sweep when MAX_WAIT expires
+   REPEAT       number of runs of the sweep, default 1
+ WARM_START, DIODE_CALIBRATION and LIVE_STREAM_PORT are fixed when the
+ instruments are brought up and can only be set in DEFAULT.
+
+ Usage: scheduler.py queue.ini [--dry-run]
+'''
+import argparse
+import configparser
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import gpib
+import experiment_io
+import acquisition
+import instruments
+from gpib_bus import GpibBus, MEASURE
+from measure_buffer import MeasureBuffer
+from stream_writer import StreamWriter, STREAM_SUFFIX
+from live_stream import LivePublisher, LIVE_PORT
+from dt470_table import DiodeCalibration
+from metrics import Metrics
+
+# Intervallo di lettura della temperatura durante l'attesa [s]
+WAIT_POLL = 5.0
+# Opzioni della sessione strumenti, fissate all'avvio: uguali in tutta la coda
+SESSION_OPTIONS = ['WARM_START', 'DIODE_CALIBRATION', 'LIVE_STREAM_PORT']
+
+
+def load_queue(path):
+    """ Sweep sections of a queue file, in order """
+    config = configparser.ConfigParser()
+    if not config.read(path, encoding='utf-8'):
+        raise FileNotFoundError(path)
+    if not config.sections():
+        raise ValueError(f"No sweep in {path}")
+    sweeps = [config[name] for name in config.sections()]
+    for option in SESSION_OPTIONS:
+        values = {conf.get(option, fallback='').strip() for conf in sweeps}
+        if len(values) > 1:
+            raise ValueError(f"{option} differs between the sweeps of {path}, "
+                             "it can only be set in DEFAULT")
+    return sweeps
+
+
+def load_calibration(conf):
+    """ Diode calibration of DIODE_CALIBRATION, or of lib.DT400TempSensor """
+    path = conf.get('DIODE_CALIBRATION', fallback='')
+    if path:
+        return DiodeCalibration.load(path)
+    from lib import DT400TempSensor as sensor  # pylint: disable=import-outside-toplevel
+    return DiodeCalibration.from_sensor(sensor.DT400TempSensor())
+
+
+def temperature_band(conf):
+    """ (minimum, maximum) temperature to start the sweep, None at once """
+    if 'T_MIN' in conf or 'T_MAX' in conf:
+        return (conf.getfloat('T_MIN', fallback=-np.inf),
+                conf.getfloat('T_MAX', fallback=np.inf))
+    if 'SETPOINT' in conf:
+        setpoint = conf.getfloat('SETPOINT')
+        band = conf.getfloat('BAND', fallback=1.0)
+        return setpoint - band, setpoint + band
+    return None
+
+
+class Scheduler:
+    """ Instrument session shared by the sweeps of a queue """
+
+    def __init__(self, conf, stop=None):
+        self.stop = stop or threading.Event()
+        self.calibration = load_calibration(conf)
+        self.metrics = Metrics()
+        self.bus = GpibBus(self.metrics)
+        self.multimeter, self.nanovolt, self.sm = instruments.bring_up(
+            self.bus, 0.0, conf['LIMIT'], conf.getboolean('WARM_START', fallback=False))
+        # I file di un run vengono scritti mentre si attende il run successivo
+        self.save_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='save')
+        # Un solo server per tutta la coda, avviato dal primo sweep con LIVE_STREAM
+        self.live = None
+
+    def live_stream(self, conf):
+        """ Publisher of the sweep, None when its LIVE_STREAM is off """
+        if not conf.getboolean('LIVE_STREAM', fallback=False):
+            return None
+        if self.live is None:
+            try:
+                self.live = LivePublisher({'title': 'queue', 'sample': conf['SAMPLE_NAME']},
+                                          port=conf.getint('LIVE_STREAM_PORT',
+                                                           fallback=LIVE_PORT))
+            except OSError as e:
+                logging.warning("Live stream not available: %s", e)
+        return self.live
+
+    def read_diode(self):
+        """ Thermometer diode voltage [V] """
+        return float(self.multimeter.query(':READ?', priority=MEASURE).result())
+
+    def temperature(self):
+        """ Temperature [K], NaN if out of the calibration """
+        try:
+            return self.calibration.voltage_to_temp(self.read_diode())
+        except ValueError:
+            return float('nan')
+
+    def wait_band(self, conf):
+        """ Wait for the band of the sweep, return False to skip it """
+        band = temperature_band(conf)
+        if band is None:
+            return True
+        max_wait = conf.getfloat('MAX_WAIT', fallback=3600.0)
+        stable_time = conf.getfloat('STABLE_TIME', fallback=0.0)
+        deadline = time.monotonic() + max_wait
+        entered = None
+        logging.info("Waiting for temperature in %.2f-%.2fK", *band)
+        while not self.stop.is_set():
+            try:
+                temp = self.temperature()
+            except gpib.GpibError as e:
+                logging.warning("Reading gpib error, check the multimeter: %s", e)
+                temp = float('nan')
+            now = time.monotonic()
+            if band[0] <= temp <= band[1]:
+                entered = now if entered is None else entered
+                if now - entered >= stable_time:
+                    logging.info("Temperature %.2fK in band", temp)
+                    return True
+            else:
+                entered = None
+            if now >= deadline:
+                run = conf.get('ON_TIMEOUT', fallback='skip') == 'run'
+                logging.warning("Temperature %.2fK not in band after %ss, %s", temp,
+                                max_wait, 'running anyway' if run else 'skipped')
+                return run
+            self.stop.wait(min(WAIT_POLL, max(deadline - now, 0.0)))
+        return False
+
+    def run_sweep(self, conf):
+        """ Run one sweep, return its rows, title, whether it is flipped and stream path
+
+        The stream path is None when STREAM_DATA is off; the stream is left
+        on disk until the run is saved.
+        """
+        source, title, flipped = acquisition.source_current(conf)
+        area, length = conf.getfloat('AREA'), conf.getfloat('LENGTH')
+        avg, delay = conf.getint('AVG_MEASURE'), conf.getfloat('DELAY')
+        limit = conf.getfloat('LIMIT')
+        data = MeasureBuffer(len(source))
+        start_time = datetime.now().strftime("%Y%m%d%H%M%S")
+        stream = None
+        if conf.getboolean('STREAM_DATA', fallback=True):
+            stream = StreamWriter(
+                experiment_io.experiment_file(conf['SAMPLE_NAME'], title, start_time) +
+                STREAM_SUFFIX, data.dtype,
+                {'title': title, 'date_time': start_time, 'source_flipped': flipped,
+                 'conf': dict(conf)})
+        self.sm.write(f':SENS:VOLT:PROT {limit}').result()
+        self.sm.write(f":SOUR:CURR {source[0]}").result()
+        logging.info('### Start experiment: %s ###', title)
+        # Ogni sweep è un nuovo run per i client
+        live = self.live_stream(conf)
+        if live is not None:
+            live.new_run({'title': title, 'sample': conf['SAMPLE_NAME'],
+                          'source_flipped': flipped})
+        # Metriche del solo sweep, senza l'attesa della temperatura
+        self.metrics.reset()
+
+        if conf.getboolean('BUFFERED_SWEEP', fallback=False):
+            try:
+                for rows in acquisition.buffered_sweep(self.sm, self.nanovolt,
+                                                       self.read_diode,
+                                                       self.calibration.voltage_to_temp,
+                                                       source, avg, delay, area, length,
+                                                       stop=self.stop):
+                    compliance = rows['voltage'] >= limit * 0.95
+                    self.metrics.count('compliance', int(np.count_nonzero(compliance)))
+                    rows = rows[~compliance]
+                    self.metrics.count('points', len(rows))
+                    data.extend(rows)
+                    if stream is not None:
+                        stream.extend(rows)
+                    if live is not None:
+                        live.extend(rows)
+            except acquisition.BufferTimeout as e:
+                # Sweep troncato, i chunk già letti vengono salvati
+                logging.warning("Buffered sweep interrupted: %s", e)
+                self.metrics.count('lost points')
+        else:
+            sweep = None
+            levels = source
+            if conf.getboolean('ADAPTIVE_SWEEP', fallback=False) and \
+                    not conf.getboolean('SOURCE_FIXED') and \
+                    not conf.getboolean('SOURCE_SQUARE_WAVE'):
+                sweep = acquisition.AdaptiveSweep(
+                    conf.getfloat('SOURCE_MIN_VALUE'), conf.getfloat('SOURCE_MAX_VALUE'),
+                    conf.getint('ADAPTIVE_COARSE_SAMPLES',
+                                fallback=max(conf.getint('SOURCE_SAMPLES') // 4, 3)),
+                    conf.getint('SOURCE_SAMPLES'), conf.getint('ADAPTIVE_BATCH', fallback=4))
+                levels = acquisition.adaptive_levels(sweep, flipped)
+            adaptive_avg = conf.getboolean('ADAPTIVE_AVG', fallback=False)
+            read_meters = instruments.select_reader(
+                self.nanovolt, self.multimeter, conf.getboolean('CONCURRENT_READ',
+                                                                fallback=False))
+            for i in levels:
+                if self.stop.is_set():
+                    break
+                try:
+                    with self.metrics.stage('loop set current'):
+                        self.sm.write(f":SOUR:CURR {i}", priority=MEASURE).result()
+                    if adaptive_avg:
+                        point = acquisition.measure_point(
+                            self.nanovolt, self.multimeter, read_meters,
+                            self.calibration.voltage_to_temp,
+                            conf.getint('AVG_MIN_SAMPLES', fallback=2), delay,
+                            conf.getfloat('AVG_TARGET_ERROR', fallback=1e-3),
+                            conf.getint('AVG_MAX_SAMPLES', fallback=avg), metrics=self.metrics)
+                    else:
+                        point = acquisition.measure_point(
+                            self.nanovolt, self.multimeter, read_meters,
+                            self.calibration.voltage_to_temp, avg, delay, metrics=self.metrics)
+                except ValueError:
+                    logging.warning('Temperature out of range!')
+                    self.metrics.count('lost points')
+                    self.metrics.count('temperature out of range')
+                    continue
+                except gpib.GpibError as e:
+                    logging.warning("Reading gpib error, check the instruments: %s", e)
+                    self.metrics.count('lost points')
+                    continue
+                if point['voltage'] >= limit * 0.95:
+                    logging.warning("Voltage compliance")
+                    self.metrics.count('compliance')
+                    continue
+                rows = acquisition.derive(
+                    np.array([i]), np.array([point['voltage']]),
+                    np.array([point['temperature']]),
+                    np.array([datetime.now()], dtype='datetime64[us]'), area, length,
+                    point['diode_voltage'], point['voltage_std'], point['temperature_std'],
+                    point['n_samples'])
+                logging.info('T:%.2f°K V:%.4eV I:%.4eA', point['temperature'],
+                             point['voltage'], i)
+                data.extend(rows)
+                if stream is not None:
+                    stream.extend(rows)
+                if live is not None:
+                    live.extend(rows)
+                if sweep is not None:
+                    sweep.add(i, point['voltage'])
+                self.metrics.count('points')
+        if stream is not None:
+            stream.close()
+        return data.history(), title, flipped, stream.path if stream is not None else None
+
+    def save(self, conf, history, title, flipped, log_file=None):
+        """ Start saving a run in the usual layout, return its base path and futures """
+        date_time = datetime.now().strftime("%Y%m%d%H%M%S")
+        path_file = experiment_io.experiment_file(conf['SAMPLE_NAME'], title, date_time)
+        futures = experiment_io.save_run(
+            self.save_pool, path_file, conf, history, date_time, flipped,
+            experiment_io.run_metadata(conf, title, date_time, flipped),
+            run_metrics=self.metrics.detach())
+        if log_file:
+            shutil.copy(log_file, path_file + ".log")
+        return path_file, futures
+
+    def close(self, switch_off=True):
+        """ Switch off the source and release the bus """
+        if switch_off:
+            try:
+                self.sm.write(':OUTP OFF').result()
+            except gpib.GpibError:
+                logging.warning("Couldn't turn off the Source Meter")
+        self.save_pool.shutdown()
+        if self.live is not None:
+            self.live.close()
+        self.bus.close()
+
+
+def run_queue(sweeps, log_file=None, stop=None):
+    """ Run every sweep of the queue, return the saved base paths """
+    scheduler = Scheduler(sweeps[0], stop)
+    saving = []
+    try:
+        for conf in sweeps:
+            for repeat in range(conf.getint('REPEAT', fallback=1)):
+                if scheduler.stop.is_set():
+                    break
+                logging.info("Sweep [%s] run %d", conf.name, repeat + 1)
+                if not scheduler.wait_band(conf):
+                    continue
+                history, title, flipped, stream_path = scheduler.run_sweep(conf)
+                if len(history) == 0:
+                    logging.warning("Data empty")
+                    remove_stream(stream_path)
+                    continue
+                saving.append(scheduler.save(conf, history, title, flipped, log_file) +
+                              (stream_path,))
+    finally:
+        scheduler.close(sweeps[-1].getboolean('SWITCH_OFF', fallback=True))
+    saved = []
+    for path_file, futures, stream_path in saving:
+        if experiment_io.wait_run(futures):
+            saved.append(path_file)
+            # Run salvato, lo stream non serve più
+            remove_stream(stream_path)
+        elif stream_path is not None:
+            logging.warning("Data stream kept in %s", stream_path)
+    return saved
+
+
+def remove_stream(stream_path):
+    """ Delete the stream of a run, if any """
+    if stream_path is not None:
+        os.remove(stream_path)
+
+
+def main():
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queue', help='queue .ini file')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the sweeps and their bands, do not measure')
+    args = parser.parse_args()
+    sweeps = load_queue(args.queue)
+    if args.dry_run:
+        for conf in sweeps:
+            _source, title, _flipped = acquisition.source_current(conf)
+            print(f"[{conf.name}] {title} x{conf.getint('REPEAT', fallback=1)} "
+                  f"band {temperature_band(conf)}")
+        return
+    log_file = args.queue.replace('.ini', '.log')
+    logging.basicConfig(filename=log_file, format='%(asctime)s %(levelname)s %(message)s',
+                        filemode='w', encoding='utf-8', level=logging.INFO)
+    try:
+        saved = run_queue(sweeps, log_file)
+    except KeyboardInterrupt:
+        # Lo stream del run interrotto resta recuperabile con recover_stream.py
+        logging.info("Queue interrupted")
+        sys.exit(-1)
+    for path in saved:
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+'''
+ Simulated GPIB backend of the measurement bench.
+ Drop-in replacement of the linux-gpib `gpib` and `Gpib` modules: the
+ Keithley 2700 multimeter (address 16), 2182A nanovoltmeter (address 7)
+ and 2400 source meter (address 24) answer the SCPI commands used by the
+ acquisition with configurable latency and noise. The sample can follow a
+ synthetic cooldown or replay the temperature and resistance of an
+ archived .npz run.
+
+ install() registers this module as `gpib` and `Gpib`, so that
+     import gpib
+     import Gpib
+     Gpib.Gpib(0, 16)
+ reach the simulated instruments.
+'''
+import sys
+import threading
+import time
+import numpy as np
+from dt470_table import DiodeCalibration
+
+# Indirizzi GPIB degli strumenti del banco
+MULTIMETER_PAD = 16
+NANOVOLT_PAD = 7
+SOURCEMETER_PAD = 24
+
+# Latenze di default [s]: 'turnaround' per ogni write/read sul bus,
+# il nome dello strumento per il tempo di integrazione di una lettura,
+# un comando SCPI per il tempo aggiuntivo di quel comando, per *RST la
+# durata del reset nello strumento con il bus libero
+DEFAULT_LATENCY = {
+    'turnaround': 0.002,
+    'multimeter': 0.05,
+    'nanovolt': 0.1,
+    'sourcemeter': 0.02,
+    '*RST': 0.3,
+}
+
+# Approssimazione lineare della curva del DT-470 sopra i 30 K
+DIODE_V300 = 0.51892
+DIODE_SLOPE = 0.002266
+DIODE_T_MIN = 30.0
+DIODE_T_MAX = 475.0
+
+
+class GpibError(Exception):
+    """ Error of a simulated GPIB transaction """
+
+
+def approx_diode_voltage(temp):
+    """ Diode voltage [V] at temperature temp [K], linear DT-470 model """
+    return DIODE_V300 + (300.0 - np.asarray(temp)) * DIODE_SLOPE
+
+
+# Tabella del modello lineare, usata come DT400TempSensor del banco simulato
+APPROX_CALIBRATION = DiodeCalibration(
+    approx_diode_voltage(np.linspace(DIODE_T_MIN, DIODE_T_MAX, 446)),
+    np.linspace(DIODE_T_MIN, DIODE_T_MAX, 446))
+
+
+def approx_diode_temperature(volt):
+    """ Inverse of approx_diode_voltage, ValueError when out of range """
+    return APPROX_CALIBRATION.voltage_to_temp(volt)
+
+
+class Trace:
+    """ Temperature [K] and resistance [Ohm] of the sample over time [s] """
+
+    def __init__(self, seconds, temperature, resistance):
+        self.seconds = np.asarray(seconds, dtype=float)
+        self.temperature = np.asarray(temperature, dtype=float)
+        self.resistance = np.asarray(resistance, dtype=float)
+        self.duration = max(self.seconds[-1], 1e-9)
+
+    @classmethod
+    def cooldown(cls, start=300.0, end=80.0, duration=3600.0, r0=10.0, alpha=0.004):
+        """ Linear cooldown of a metallic sample """
+        seconds = np.linspace(0.0, duration, 1001)
+        temperature = np.linspace(start, end, len(seconds))
+        resistance = r0 * (1 + alpha * (temperature - start))
+        return cls(seconds, temperature, resistance)
+
+    @classmethod
+    def from_npz(cls, path):
+        """ Replay an archived run saved by the acquisition """
+        data = np.load(path, allow_pickle=True)
+        stamps = np.asarray(data['datetime'], dtype='datetime64[us]')
+        seconds = (stamps - stamps[0]) / np.timedelta64(1, 's')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resistance = data['voltage'] / data['current_source']
+        # Resistenza non definita a corrente nulla: interpolazione dai vicini
+        finite = np.isfinite(resistance)
+        if not np.any(finite):
+            raise ValueError(f"{path} has no finite resistance")
+        resistance = np.interp(seconds, seconds[finite], resistance[finite])
+        return cls(seconds, data['temperature'], resistance)
+
+    def at(self, seconds):
+        """ (temperature, resistance) at the given time, looping the trace """
+        t = np.mod(seconds, self.duration)
+        return (np.interp(t, self.seconds, self.temperature),
+                np.interp(t, self.seconds, self.resistance))
+
+
+class SimLab:
+    """ Simulated bench: sample trace, source current and the instruments
+
+    speed scales the replay of the trace, a speed of 60 runs an hour of
+    archived data in a minute.
+    """
+
+    def __init__(self, trace=None, latency=None, noise=1e-3, temp_noise=0.01,
+                 speed=1.0, seed=None):
+        self.trace = trace if trace is not None else Trace.cooldown()
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.noise = noise
+        self.temp_noise = temp_noise
+        self.speed = speed
+        self.rng = np.random.default_rng(seed)
+        self.current = 0.0
+        self.output = False
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self.instruments = {MULTIMETER_PAD: SimMultimeter(self),
+                            NANOVOLT_PAD: SimNanovolt(self),
+                            SOURCEMETER_PAD: SimSourceMeter(self)}
+
+    def scale_latency(self, factor):
+        """ Multiply every latency by factor """
+        self.latency = {key: value * factor for key, value in self.latency.items()}
+
+    def pause(self, key):
+        """ Sleep for the latency configured for key, if any """
+        delay = self.latency.get(key, 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def elapsed(self, at=None):
+        """ Seconds of trace elapsed at the monotonic time `at` """
+        at = time.monotonic() if at is None else at
+        return (at - self._t0) * self.speed
+
+    def sample_voltage(self, at=None, current=None):
+        """ Voltage across the sample with noise """
+        current = self.current if current is None else current
+        _temp, resistance = self.trace.at(self.elapsed(at))
+        volt = resistance * current if self.output else 0.0
+        with self._lock:
+            return volt * (1 + self.noise * self.rng.standard_normal()) + \
+                1e-8 * self.rng.standard_normal()
+
+    def diode_voltage(self, at=None):
+        """ Thermometer diode voltage with noise """
+        temp, _resistance = self.trace.at(self.elapsed(at))
+        with self._lock:
+            temp = temp + self.temp_noise * self.rng.standard_normal()
+        return float(approx_diode_voltage(temp))
+
+
+class SimInstrument:
+    """ SCPI parser shared by the simulated instruments
+
+    The settings written by the commands are kept and answered by the
+    corresponding queries (':SENS:FUNC?' after ':SENS:FUNC'), starting from
+    the *RST values in `defaults`. Several commands can be sent in one
+    message separated by ';', their answers are joined by ';'. *RST goes on
+    inside the instrument: the bus is free, the instrument answers again
+    when the reset is over. *WAI holds the following commands of the
+    message until the operations in progress are complete.
+    """
+    name = ''
+    idn = ''
+    defaults = {}
+
+    def __init__(self, lab):
+        self.lab = lab
+        self._answer = None
+        self._busy_until = 0.0
+        self._waiting = False
+        self.settings = dict(self.defaults)
+        self.reset()
+
+    def reset(self):
+        """ *RST state """
+
+    def wait_ready(self):
+        """ Wait for the end of a running *RST """
+        wait = self._busy_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def write(self, command):
+        """ Gpib.write """
+        self.lab.pause('turnaround')
+        self.wait_ready()
+        self._waiting = False
+        answers = [self.execute(part) for part in command.split(';') if part.strip()]
+        answers = [answer for answer in answers if answer is not None]
+        if len(answers) > 1:
+            def joined():
+                return b';'.join((answer() if callable(answer) else answer).strip()
+                                 for answer in answers) + b'\n'
+            self._answer = joined
+        else:
+            self._answer = answers[0] if answers else None
+
+    def execute(self, command):
+        """ Execute one command of a message, return its answer if any """
+        head, _, arg = command.strip().partition(' ')
+        head = head.upper()
+        arg = arg.strip()
+        if head == '*RST':
+            self.settings = dict(self.defaults)
+            self.reset()
+            self._busy_until = time.monotonic() + self.lab.latency.get(head, 0.0)
+            return None
+        if head == '*WAI':
+            self._waiting = True
+            return None
+        self.lab.pause(head)
+        if head == '*IDN?':
+            return self.idn.encode()
+        if head.endswith('?') and head[:-1] in self.settings:
+            return f"{self.settings[head[:-1]]}\n".encode()
+        if not head.endswith('?'):
+            self.settings[head] = arg
+        return self.command(head, arg)
+
+    def read(self, length=512):
+        """ Gpib.read, blocks until the pending answer is ready """
+        self.lab.pause('turnaround')
+        self.wait_ready()
+        answer, self._answer = self._answer, None
+        if answer is None:
+            raise GpibError(f"{self.name}: read with no pending answer")
+        if callable(answer):
+            answer = answer()
+        return answer[:length]
+
+    def command(self, head, arg):
+        """ Execute a command, return the answer (bytes or callable) if any """
+        raise NotImplementedError
+
+
+class SimMeter(SimInstrument):
+    """ Meter with single triggered readings: :READ?, :INIT, :FETC? """
+
+    def reset(self):
+        self._ready_at = None
+        self._reading = 0.0
+
+    def measure(self, at):
+        """ Reading taken at the monotonic time `at` """
+        raise NotImplementedError
+
+    def trigger(self):
+        """ Start an integration """
+        self._ready_at = time.monotonic() + self.lab.latency.get(self.name, 0.0)
+
+    def fetch(self, wait):
+        """ Answer of :FETC?
+
+        As the real meters, without wait (*WAI before :FETC?) the answer
+        is the previous reading while the integration is still running.
+        """
+        def answer():
+            if self._ready_at is not None:
+                remaining = self._ready_at - time.monotonic()
+                if remaining > 0 and wait:
+                    time.sleep(remaining)
+                if remaining <= 0 or wait:
+                    self._reading = self.measure(self._ready_at)
+                    self._ready_at = None
+            return f"{self._reading:+.8E}\n".encode()
+        return answer
+
+    def command(self, head, arg):
+        if head == ':READ?':
+            self.trigger()
+            return self.fetch(wait=True)
+        if head in (':INIT', ':INIT:IMM'):
+            self.trigger()
+        elif head in (':FETC?', ':FETCH?'):
+            return self.fetch(self._waiting)
+        return None
+
+
+class SimMultimeter(SimMeter):
+    """ Keithley 2700 reading the thermometer diode """
+    name = 'multimeter'
+    idn = 'KEITHLEY INSTRUMENTS INC.,MODEL 2700,0000000,SIM'
+    defaults = {':SENS:FUNC': '"VOLT:DC"', ':FORM:ELEM': 'READ,UNIT,TST,RNUM'}
+
+    def measure(self, at):
+        return self.lab.diode_voltage(at)
+
+
+class SimNanovolt(SimMeter):
+    """ Keithley 2182A reading the sample voltage, with trace buffer """
+    name = 'nanovolt'
+    idn = 'KEITHLEY INSTRUMENTS INC.,MODEL 2182A,0000000,SIM'
+    defaults = {':SENS:FUNC': '"VOLT"', ':SENS:CHAN': '1', ':TRIG:SOUR': 'IMM',
+                ':FORM:DATA': 'ASC', ':FORM:BORD': 'NORM', ':TRIG:COUN': '+1',
+                ':TRAC:POIN': '+2', ':TRAC:FEED': 'SENS', ':TRAC:FEED:CONT': 'NEV',
+                ':SENS:VOLT:NPLC': '+5.00000000E+00'}
+
+    def reset(self):
+        super().reset()
+        self.external = False
+        self.armed = False
+        self.binary = False
+        self.swapped = False
+        self.buffer_size = 0
+        # Letture del buffer e istante in cui ciascuna è disponibile
+        self.buffer = np.empty(0)
+        self.buffer_times = np.empty(0)
+
+    def measure(self, at):
+        return self.lab.sample_voltage(at)
+
+    def fill_buffer(self, currents, step):
+        """ Readings of a source list, one every `step` seconds """
+        start = time.monotonic()
+        self.buffer_times = start + step * (np.arange(len(currents)) + 1)
+        self.buffer = np.array([self.lab.sample_voltage(at, current)
+                                for at, current in zip(self.buffer_times, currents)])
+        self.armed = False
+
+    def command(self, head, arg):
+        if head == ':TRIG:SOUR':
+            self.external = arg.upper().startswith('EXT')
+        elif head in (':INIT', ':INIT:IMM') and self.external:
+            self.armed = True
+        elif head == ':ABOR':
+            self.armed = False
+        elif head == ':TRAC:CLE':
+            self.buffer = np.empty(0)
+            self.buffer_times = np.empty(0)
+        elif head == ':TRAC:POIN':
+            self.buffer_size = int(arg)
+        elif head == ':TRAC:POIN:ACT?':
+            done = np.count_nonzero(self.buffer_times <= time.monotonic())
+            return f"{done}\n".encode()
+        elif head == ':FORM:DATA':
+            self.binary = arg.upper().startswith('SRE')
+        elif head == ':FORM:BORD':
+            self.swapped = arg.upper().startswith('SWAP')
+        elif head == ':TRAC:DATA?':
+            return self.trace_data()
+        else:
+            return super().command(head, arg)
+        return None
+
+    def trace_data(self):
+        """ Buffer content, ASCII or IEEE 488.2 single precision block """
+        if not self.binary:
+            return (','.join(f"{v:+.8E}" for v in self.buffer) + '\n').encode()
+        payload = self.buffer.astype('<f4' if self.swapped else '>f4').tobytes()
+        length = str(len(payload))
+        return f"#{len(length)}{length}".encode() + payload + b'\n'
+
+
+class SimSourceMeter(SimInstrument):
+    """ Keithley 2400 current source, fixed level or source list """
+    name = 'sourcemeter'
+    idn = 'KEITHLEY INSTRUMENTS INC.,MODEL 2400,0000000,SIM'
+    defaults = {':SOUR:FUNC': 'VOLT', ':SENS:FUNC': '"CURR:DC"',
+                ':FORM:ELEM': 'VOLT,CURR,RES,TIME,STAT', ':SOUR:CURR:MODE': 'FIX',
+                ':OUTP': '0', ':TRIG:COUN': '1', ':TRIG:OUTP': 'NONE', ':TRIG:OLIN': '2',
+                ':TRIG:ILIN': '1', ':TRIG:INP': 'SOUR', ':SOUR:DEL': '+0.00000E+00',
+                ':SOUR:DEL:AUTO': '1'}
+
+    def reset(self):
+        self.list_mode = False
+        self.levels = np.empty(0)
+        self.source_delay = 0.0
+        self.lab.output = False
+        self.lab.current = 0.0
+
+    def command(self, head, arg):
+        if head in (':SOUR:CURR', ':SOUR:CURR:LEV', ':SOUR:CURR:LEV:IMM'):
+            self.lab.current = float(arg)
+        elif head == ':OUTP':
+            self.lab.output = arg.upper() in ('ON', '1')
+        elif head == ':SOUR:CURR:MODE':
+            self.list_mode = arg.upper().startswith('LIST')
+        elif head == ':SOUR:LIST:CURR':
+            self.levels = np.array([float(v) for v in arg.split(',')])
+        elif head == ':SOUR:DEL':
+            self.source_delay = float(arg)
+            self.settings[':SOUR:DEL:AUTO'] = '0'
+        elif head in (':INIT', ':INIT:IMM') and self.list_mode:
+            self.run_list()
+        elif head == ':READ?':
+            return f"{self.lab.sample_voltage():+.8E}\n".encode()
+        return None
+
+    def run_list(self):
+        """ Step through the source list triggering the armed nanovoltmeter """
+        nanovolt = self.lab.instruments[NANOVOLT_PAD]
+        step = self.source_delay + self.lab.latency.get(self.name, 0.0) + \
+            self.lab.latency.get(nanovolt.name, 0.0)
+        if nanovolt.armed:
+            nanovolt.fill_buffer(self.levels, step)
+        if len(self.levels):
+            self.lab.current = self.levels[-1]
+
+
+# Banco usato da Gpib(), sostituibile con install()
+default_lab = None
+
+
+class Gpib:
+    """ Simulated Gpib.Gpib(board, pad) handle """
+
+    def __init__(self, board=0, pad=0, *_args, **_kwargs):
+        global default_lab
+        if default_lab is None:
+            default_lab = SimLab()
+        if pad not in default_lab.instruments:
+            raise GpibError(f"No instrument at GPIB address {board}:{pad}")
+        self.instrument = default_lab.instruments[pad]
+
+    def write(self, command):
+        """ Send a command """
+        self.instrument.write(command)
+
+    def read(self, length=512):
+        """ Read the answer """
+        return self.instrument.read(length)
+
+
+def install(lab=None):
+    """ Register the simulator as the `gpib` and `Gpib` modules
+
+    Call it before importing the acquisition modules. Without lab the bench
+    is left as it is, Gpib() creates it on first use.
+    """
+    global default_lab
+    if lab is not None:
+        default_lab = lab
+    module = sys.modules[__name__]
+    sys.modules['gpib'] = module
+    sys.modules['Gpib'] = module
+    return default_lab
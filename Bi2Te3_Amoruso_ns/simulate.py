@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+'''
+ Run the acquisition script on the simulated GPIB bench.
+ The script reads its usual .ini file; the instruments answer from
+ sim_gpib with the latency and noise given on the command line.
+
+ Usage: simulate.py [--replay run.npz] [--speed 60] [--latency-scale 1]
+                    [--noise 1e-3] [script.py] [script arguments]
+'''
+import argparse
+import os
+import runpy
+import sys
+import sim_gpib
+
+# Moduli gpib e Gpib simulati già all'import, prima di qualsiasi script
+sim_gpib.install()
+
+
+def main():
+    """ Install the simulated backend and run the acquisition script """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'exp_ec_i_sourceAG.py'))
+    parser.add_argument('--replay', help='archived .npz run to replay')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed of the sample trace')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='factor applied to every instrument latency')
+    parser.add_argument('--noise', type=float, default=1e-3,
+                        help='relative noise of the sample voltage')
+    args, script_args = parser.parse_known_args()
+
+    trace = sim_gpib.Trace.from_npz(args.replay) if args.replay else None
+    lab = sim_gpib.SimLab(trace=trace, noise=args.noise, speed=args.speed)
+    lab.scale_latency(args.latency_scale)
+    sim_gpib.install(lab)
+    # Lo script cerca .ini e .log accanto a sys.argv[0]
+    sys.argv = [args.script] + script_args
+    runpy.run_path(args.script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+ Crash-safe, append-only stream of the measurements.
+ The measurement thread queues every point and a writer thread appends
+ them to disk in checksummed chunks, so at most the last unflushed batch
+ is lost if the acquisition dies before the data is saved.
+
+ File layout:
+   MAGIC, header length (uint32), JSON header with the run metadata
+   and the row dtype, then any number of chunks made of
+   CHUNK_MAGIC, number of rows (uint32), crc32 (uint32), raw rows.
+'''
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+MAGIC = b'SPINSTRM\x01'
+CHUNK_MAGIC = b'CHNK'
+_UINT32 = struct.Struct('<I')
+_CHUNK = struct.Struct('<4sII')
+
+# Estensione del file di stream
+STREAM_SUFFIX = '.stream'
+
+
+class StreamWriter:
+    """ Writer thread appending measurement rows to a stream file
+
+    append() never blocks the caller: rows go through a bounded queue and
+    are written in batches of batch_size rows, or every flush_interval
+    seconds when points arrive slowly.
+    """
+
+    def __init__(self, path, dtype, header, batch_size=32, flush_interval=10.0,
+                 max_queue=100000):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        header = dict(header, dtype=np.lib.format.dtype_to_descr(self.dtype))
+        encoded = json.dumps(header).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + _UINT32.pack(len(encoded)) + encoded)
+        self._sync()
+        self._thread = threading.Thread(target=self._run, name='stream-writer',
+                                        daemon=True)
+        self._thread.start()
+
+    def append(self, **values):
+        """ Queue one row, one keyword per field of the dtype """
+        row = tuple(values[name] for name in self.dtype.names)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            logging.warning("Stream queue full, point not written to %s", self.path)
+
+    def extend(self, rows):
+        """ Queue every row of a structured array """
+        for row in rows.tolist():
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+                logging.warning("Stream queue full, point not written to %s", self.path)
+
+    def close(self):
+        """ Write the pending rows and close the file """
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _write_chunk(self, rows):
+        payload = np.array(rows, dtype=self.dtype).tobytes()
+        self._file.write(_CHUNK.pack(CHUNK_MAGIC, len(rows), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._sync()
+
+    def _run(self):
+        """ Writer thread, batches the queued rows """
+        rows = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(deadline - time.monotonic(), 0.0)
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                row = ()
+            if row is None:
+                break
+            if row:
+                rows.append(row)
+            if len(rows) >= self.batch_size or (rows and time.monotonic() >= deadline):
+                try:
+                    self._write_chunk(rows)
+                except OSError as error:
+                    logging.error("Error writing the data stream: %s", error)
+                rows = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+        if rows:
+            try:
+                self._write_chunk(rows)
+            except OSError as error:
+                logging.error("Error writing the data stream: %s", error)
+
+
+def read_stream(path):
+    """ Read a stream file, return (header, rows)
+
+    Reading stops at the first truncated or corrupted chunk, which is what
+    is left behind when the acquisition dies in the middle of a write.
+    """
+    with open(path, 'rb') as file:
+        content = file.read()
+    if not content.startswith(MAGIC):
+        raise ValueError(f"{path} is not a measurement stream")
+    offset = len(MAGIC)
+    (length,) = _UINT32.unpack_from(content, offset)
+    offset += _UINT32.size
+    header = json.loads(content[offset:offset + length].decode('utf-8'))
+    offset += length
+    dtype = np.lib.format.descr_to_dtype(
+        [tuple(field) for field in header['dtype']])
+    chunks = []
+    while offset + _CHUNK.size <= len(content):
+        magic, count, crc = _CHUNK.unpack_from(content, offset)
+        start = offset + _CHUNK.size
+        end = start + count * dtype.itemsize
+        if magic != CHUNK_MAGIC or end > len(content) or \
+                zlib.crc32(content[start:end]) != crc:
+            logging.warning("Stream %s truncated after %d rows", path,
+                            sum(len(chunk) for chunk in chunks))
+            break
+        chunks.append(np.frombuffer(content, dtype=dtype, count=count, offset=start))
+        offset = end
+    if chunks:
+        rows = np.concatenate(chunks)
+    else:
+        rows = np.empty(0, dtype=dtype)
+    return header, rows